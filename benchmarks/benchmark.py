@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+#
+# Copyright (c) 2022 Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Benchmarks for decoding sensor data, reading a fleet of devices and building and
+# publishing the mqtt messages. No bluetooth adapter or mqtt broker is needed: devices are
+# simulated and the broker is replaced by a stand-in that acknowledges every message from
+# its own thread, as paho does. Random values are seeded so runs can be compared.
+#
+# Usage:
+#   python3 benchmarks/benchmark.py [decode|cycle|publish|all] [--json results.json]
+
+import argparse, asyncio, importlib.util, itertools, json, logging, os, queue, statistics, struct, sys, threading, time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+import paho.mqtt.client as mqtt
+import airthings
+from mqtt_session import MQTTSession
+from simulator import SimulatedTransport
+
+RESULTS = []
+
+def load_bridge():
+    # The main script's name is not a valid module name, so load it from its path.
+    spec = importlib.util.spec_from_file_location("airthings_mqtt_ha", os.path.join(SRC, "airthings-mqtt-ha.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def report(group, name, seconds, unit, count=1):
+    # Record a result, given the best time in seconds for count operations.
+    result = {"group": group, "name": name, "seconds": seconds, "per_op": seconds / count, "ops_per_sec": count / seconds if seconds else 0.0}
+    RESULTS.append(result)
+    print("{:<8} {:<40} {:>12.3f} {}/op {:>14,.0f} ops/s".format(group, name, result["per_op"] * (1e6 if unit == "us" else 1e3), unit, result["ops_per_sec"]))
+
+def best_of(repeat, func):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+def sample_frame(decoder):
+    # A valid raw frame for a decoder, with fixed values.
+    if isinstance(decoder, airthings.CommandDecode):
+        return decoder.cmd + b'\x00' + struct.pack(decoder.format_type, 0, *([1] * 12), 0, 0, 0, 0, 3000, 0)
+    count = len(struct.unpack(decoder.format_type, bytes(struct.calcsize(decoder.format_type))))
+    if isinstance(decoder, airthings.WaveDecodeDate):
+        return struct.pack(decoder.format_type, 2022, 8, 5, 12, 30, 0)
+    return struct.pack(decoder.format_type, *([1] * count))
+
+def bench_decode(args):
+    decoders = list(airthings.sensor_decoders.items()) + list(airthings.command_decoders.items())
+    for uuid, decoder in decoders:
+        frame = sample_frame(decoder)
+        best, _ = best_of(args.repeat, lambda: [decoder.decode_data(frame) for _ in range(args.number)])
+        report("decode", decoder.name, best, "us", args.number)
+
+    # Frames of one characteristic recorded back to back, decoded in bulk.
+    uuid = airthings.CHAR_UUID_WAVE_PLUS_DATA
+    recorded = sample_frame(airthings.decoders.get(uuid)) * args.number
+    best, _ = best_of(args.repeat, lambda: list(airthings.decoders.decode_recorded(uuid, recorded)))
+    report("decode", "Pluss, recorded", best, "us", args.number)
+
+async def read_fleet(devices, concurrency, args):
+    transport = SimulatedTransport(wave_plus=devices, connect_latency=args.connect_latency, read_latency=args.read_latency, seed=devices)
+    detect = airthings.AirthingsWaveDetect(0, max_concurrent=concurrency, transport=transport)
+    detect.airthing_devices = list(transport.devices)
+    await detect.onboard()
+    times = []
+    for _ in range(args.cycles):
+        start = time.perf_counter()
+        await detect.get_sensor_data()
+        times.append(time.perf_counter() - start)
+    await detect.close()
+    return min(times)
+
+def bench_cycle(args):
+    for devices in args.devices:
+        for concurrency in args.concurrency:
+            best = asyncio.run(read_fleet(devices, concurrency, args))
+            report("cycle", "{} devices, max_concurrent {}".format(devices, concurrency), best, "ms")
+
+class StandInBroker:
+    """Takes the place of the paho client, acknowledging each message from a separate thread."""
+
+    def __init__(self):
+        self.on_connect = self.on_disconnect = self.on_publish = self.on_message = None
+        self._mids = itertools.count(1)
+        self._acks = queue.Queue()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            mid = self._acks.get()
+            if mid is None:
+                return
+            self.on_publish(self, None, mid)
+
+    def username_pw_set(self, username, password): pass
+    def max_inflight_messages_set(self, inflight): pass
+    def max_queued_messages_set(self, queue_size): pass
+    def reconnect_delay_set(self, min_delay=1, max_delay=120): pass
+    def connect_async(self, host, port, keepalive): pass
+    def subscribe(self, topic): pass
+    def disconnect(self): pass
+    def is_connected(self): return self._thread is not None
+
+    def loop_start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self.on_connect(self, None, {}, 0)
+
+    def loop_stop(self):
+        self._acks.put(None)
+        self._thread.join()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        info = mqtt.MQTTMessageInfo(next(self._mids))
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        self._acks.put(info.mid)
+        return info
+
+def fleet_data(devices):
+    # Decoded sensor values for a fleet of simulated devices.
+    transport = SimulatedTransport(wave_plus=devices, seed=devices)
+    decoder = airthings.sensor_decoders[str(airthings.CHAR_UUID_WAVE_PLUS_DATA)]
+    command = airthings.command_decoders[str(airthings.COMMAND_UUID)]
+    sensors = {}
+    for mac, device in transport.devices.items():
+        sensors[mac] = decoder.decode_data(device.read(str(airthings.CHAR_UUID_WAVE_PLUS_DATA)))
+        sensors[mac].update(command.decode_data(device.command(command.cmd)))
+    return sensors
+
+async def publish_all(msgs):
+    session = MQTTSession("localhost", client=StandInBroker())
+    await session.connect()
+    start = time.perf_counter()
+    await session.publish_multiple(msgs)
+    elapsed = time.perf_counter() - start
+    await session.close()
+    return elapsed
+
+def bench_publish(args):
+    bridge = load_bridge()
+    bridge.CONFIG.update({"mqtt_retain": False})
+    for devices in args.devices:
+        sensors = fleet_data(devices)
+        for i, mac in enumerate(sensors):
+            bridge.DEVICES[mac] = {"name": "Device {}".format(i)}
+
+        def discovery():
+            bridge.DISCOVERY.clear()
+            bridge.DISCOVERY_HASHES.clear()
+            bridge.discovery_messages(sensors)
+        best, _ = best_of(args.repeat, discovery)
+        report("publish", "discovery messages, {} devices".format(devices), best, "ms", devices)
+
+        best, _ = best_of(args.repeat, lambda: bridge.sensor_messages(sensors))
+        report("publish", "sensor messages, {} devices".format(devices), best, "ms", devices)
+
+        msgs = bridge.sensor_messages(sensors)
+        best = min(asyncio.run(publish_all(msgs)) for _ in range(args.repeat))
+        report("publish", "publish {} messages".format(len(msgs)), best, "us", len(msgs))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for airthings-mqtt-ha that run without bluetooth or an mqtt broker.")
+    parser.add_argument('benchmark', nargs='?', default='all', choices=['decode', 'cycle', 'publish', 'all'], help='which benchmarks to run (default is "all")')
+    parser.add_argument('--devices', type=lambda s: [int(x) for x in s.split(",")], default=[1, 10, 100, 500], help='comma separated fleet sizes (default is "1,10,100,500")')
+    parser.add_argument('--concurrency', type=lambda s: [int(x) for x in s.split(",")], default=[1, 8], help='comma separated max_concurrent values for the cycle benchmark (default is "1,8")')
+    parser.add_argument('--connect_latency', type=float, default=0.05, help='average time in seconds to connect to a simulated device (default is 0.05)')
+    parser.add_argument('--read_latency', type=float, default=0.005, help='average time in seconds for each read from a simulated device (default is 0.005)')
+    parser.add_argument('--cycles', type=int, default=3, help='number of cycles timed in the cycle benchmark (default is 3)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of times each benchmark is repeated, the best time is reported (default is 5)')
+    parser.add_argument('--number', type=int, default=10000, help='number of decodes per repeat in the decode benchmark (default is 10000)')
+    parser.add_argument('--json', type=str, default=None, help='also write the results to this file')
+    args = parser.parse_args()
+
+    # Logging is not what is being measured.
+    logging.basicConfig(level=logging.CRITICAL)
+
+    if args.benchmark in ("decode", "all"):
+        bench_decode(args)
+    if args.benchmark in ("cycle", "all"):
+        bench_cycle(args)
+    if args.benchmark in ("publish", "all"):
+        bench_publish(args)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"python": sys.version, "args": {k: v for k, v in vars(args).items()}, "results": RESULTS}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
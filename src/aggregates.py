@@ -0,0 +1,225 @@
+# Copyright (c) 2022 Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Rolling-window statistics (mean, min, max and percentiles) of the sensor values, kept
+# up to date as each reading arrives so they can be sent as sensors of their own instead
+# of being worked out from the Home Assistant history.
+
+import bisect
+import math
+from collections import deque
+
+STATS = ("mean", "min", "max")
+
+
+def window_name(seconds):
+    # Short name for a window, e.g. 3600 -> "1h", 86400 -> "24h", 900 -> "15m".
+    if seconds % 3600 == 0:
+        return "{}h".format(seconds // 3600)
+    if seconds % 60 == 0:
+        return "{}m".format(seconds // 60)
+    return "{}s".format(seconds)
+
+
+def parse_stat(stat):
+    # Returns the stat name, or the percentile as a number for stats such as "p95".
+    stat = str(stat).lower()
+    if stat in STATS:
+        return stat
+    if stat.startswith("p") and stat[1:].replace(".", "", 1).isdigit() and 0 <= float(stat[1:]) <= 100:
+        return float(stat[1:])
+    raise ValueError("Unknown statistic {}, use mean, min, max or a percentile such as p95".format(stat))
+
+
+class RollingWindow:
+    """The values of one sensor over the last window seconds.
+
+    The mean is kept as a running sum, and the min and max with monotonic queues, so adding
+    a value and dropping the expired ones takes constant time on average. The running sum is
+    worked out again from the values each time the window has turned over, so rounding
+    errors do not build up. Percentiles, if needed, come from a count of each different value
+    in the window. The sensors report values in fixed steps (such as 1 ppm or 0.01 C), so
+    there are far fewer different values than values, and adding one only touches the sorted
+    list of them when it is a value not in the window yet.
+    """
+
+    def __init__(self, window, counts=False):
+        self.window = window
+        self._values = deque()  # (timestamp, value), oldest first
+        self._added = 0         # number of values ever added, used to identify them
+        self._sum = 0.0
+        self._summed = 0        # values added since the sum was last worked out again
+        self._min = deque()     # (number, value) of candidates for the minimum, increasing
+        self._max = deque()     # (number, value) of candidates for the maximum, decreasing
+        self._counts = {} if counts else None   # value -> number of times in the window
+        self._keys = []         # the values in _counts, sorted
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, timestamp, value):
+        self._values.append((timestamp, value))
+        self._added += 1
+        self._sum += value
+        while self._min and self._min[-1][1] > value:
+            self._min.pop()
+        self._min.append((self._added, value))
+        while self._max and self._max[-1][1] < value:
+            self._max.pop()
+        self._max.append((self._added, value))
+        if self._counts is not None:
+            count = self._counts.get(value)
+            if count:
+                self._counts[value] = count + 1
+            else:
+                self._counts[value] = 1
+                bisect.insort(self._keys, value)
+        self.expire(timestamp)
+        self._summed += 1
+        if self._summed >= len(self._values):
+            self._sum = math.fsum(v for _, v in self._values)
+            self._summed = 0
+
+    def expire(self, now):
+        # Drop the values older than the window.
+        while self._values and self._values[0][0] <= now - self.window:
+            timestamp, value = self._values.popleft()
+            self._sum -= value
+            # The number of the value just dropped.
+            dropped = self._added - len(self._values)
+            if self._min[0][0] == dropped:
+                self._min.popleft()
+            if self._max[0][0] == dropped:
+                self._max.popleft()
+            if self._counts is not None:
+                count = self._counts[value] - 1
+                if count:
+                    self._counts[value] = count
+                else:
+                    del self._counts[value]
+                    del self._keys[bisect.bisect_left(self._keys, value)]
+        if not self._values:
+            self._sum = 0.0
+
+    def mean(self):
+        return self._sum / len(self._values) if self._values else None
+
+    def min(self):
+        return self._min[0][1] if self._min else None
+
+    def max(self):
+        return self._max[0][1] if self._max else None
+
+    def percentile(self, p):
+        # Nearest-rank percentile.
+        if not self._counts:
+            return None
+        rank = max(1, -(-len(self._values) * p // 100))
+        seen = 0
+        for value in self._keys:
+            seen += self._counts[value]
+            if seen >= rank:
+                return value
+        return self._keys[-1]
+
+    def stat(self, stat):
+        if stat == "mean":
+            return self.mean()
+        if stat == "min":
+            return self.min()
+        if stat == "max":
+            return self.max()
+        return self.percentile(stat)
+
+
+class Aggregates:
+    """Rolling-window statistics for each device, set up from the "aggregates" option, e.g.
+
+        [{"sensor": "co2", "window": 3600, "stats": ["mean"]},
+         {"sensor": "voc", "window": 86400, "stats": ["max", "p95"]}]
+
+    Each statistic is a sensor of its own, named e.g. "co2_mean_1h" or "voc_p95_24h".
+
+    Devices are often read more than once per measurement, and more often while their
+    values are high with poll rules, so only readings of a new measurement are added. Those
+    are spotted from the measurement counter if it was just read, and otherwise from the
+    values changing, or at least period seconds passing since the last reading that was added.
+    """
+
+    def __init__(self, config, period=300):
+        # (sensor, window) -> [(name, stat)], and the sensor each name is worked out from.
+        self._windows = {}
+        self.sensors = {}
+        for entry in config:
+            sensor, window = entry["sensor"], int(entry["window"])
+            for s in entry.get("stats", ["mean"]):
+                stat = parse_stat(s)
+                name = "{}_{}_{}".format(sensor, str(s).lower(), window_name(window))
+                self._windows.setdefault((sensor, window), []).append((name, stat))
+                self.sensors[name] = sensor
+        self.period = period
+        self._devices = {}
+        self._last = {}     # mac -> (measurement counter, values, timestamp) last added
+
+    def __bool__(self):
+        return bool(self.sensors)
+
+    def _is_new(self, mac, timestamp, values, counter):
+        # True if values are from a measurement that has not been added yet. counter is the
+        # measurement counter if it was read with them, else None.
+        snapshot = [(k, v) for k, v in values.items() if k != "measurement_periods"]
+        last = self._last.get(mac)
+        if last is not None:
+            if counter is not None and last[0] is not None:
+                new = counter != last[0]
+            else:
+                new = snapshot != last[1] or timestamp - last[2] >= self.period
+            if not new:
+                if counter is not None:
+                    # Compare the counters from here on.
+                    self._last[mac] = (counter, last[1], last[2])
+                return False
+        self._last[mac] = (counter, snapshot, timestamp)
+        return True
+
+    def add(self, mac, timestamp, values, fresh=None):
+        # Add the sensor values of a device read at timestamp (seconds), if they are from a
+        # new measurement, and return the statistics for it by name. values are all of the
+        # values known for the device, and fresh those just read if only some of them were,
+        # for example with read_every, as the values not read can be out of date.
+        windows = self._devices.get(mac)
+        if windows is None:
+            windows = self._devices[mac] = {key: RollingWindow(key[1], any(not isinstance(stat, str) for _, stat in stats))
+                                            for key, stats in self._windows.items()}
+        counter = (values if fresh is None else fresh).get("measurement_periods")
+        new = self._is_new(mac, timestamp, values, counter)
+        results = {}
+        for (sensor, window), stats in self._windows.items():
+            value = values.get(sensor)
+            w = windows[(sensor, window)]
+            if new and isinstance(value, (int, float)):
+                w.add(timestamp, value)
+            else:
+                w.expire(timestamp)
+            for name, stat in stats:
+                result = w.stat(stat)
+                if result is not None:
+                    results[name] = result
+        return results
@@ -28,15 +28,25 @@
 # To fix connection issues:
 #   bluetoothctl -- remove 58:93:D8:8B:12:7C
 
-import logging, json, sys, os, argparse, re, asyncio
-import paho.mqtt.publish as publish
+import logging, json, sys, os, argparse, re, asyncio, time, hashlib
 from paho.mqtt import MQTTException
-from airthings import AirthingsWaveDetect
+from airthings import AirthingsWaveDetect, GattCache, AdvertisementMonitor, PollingRules
+from mqtt_session import MQTTSession, PublishFilter
+from simulator import SimulatedTransport
+from metrics import BridgeMetrics, MetricsServer
+from buffer import ReadingBuffer
+from aggregates import Aggregates
 
 _LOGGER = logging.getLogger(__name__)
 
 CONFIG = {}     # Variable to store configuration
 DEVICES = {}    # Variable to store devices
+MQTT = None     # Variable to store the mqtt broker session
+METRICS = None  # Variable to store the metrics, if enabled
+BUFFER = None   # Variable to store readings that could not be sent, if enabled
+AGGREGATES = None   # Variable to store the rolling-window aggregates, if enabled
+DISCOVERY = {}  # Variable to store HA mqtt discovery device details and messages
+DISCOVERY_HASHES = {}   # Variable to store hashes of the HA mqtt discovery messages already sent
 
 # Sensor detail defaults (for MQTT discovery)
 SENSORS = {
@@ -51,13 +61,24 @@ SENSORS = {
     "battery": {"name": "Battery", "device_class": "battery", "unit_of_measurement": "%", "icon": None, "state_class": "measurement"}
 }
 
+# Values read from the devices that are only used internally and not sent to the mqtt broker
+NOT_PUBLISHED = ["date_time", "measurement_periods"]
+
 class ATSensors:
 
     sensors_list = []
 
-    def __init__(self, scan_interval, devices=None):
+    def __init__(self, scan_interval, devices=None, max_concurrent=1, gatt_cache=None, keep_alive=False, read_every=None,
+                 adaptive=False, advertisements=None, transport=None, metrics=None, adapters=None, device_adapters=None,
+                 failure_threshold=5, probe_interval=900, connect_timeout=30, read_timeout=10, cycle_timeout=0, polling=None):
         _LOGGER.info("Setting up Airthings sensors...")
-        self.airthingsdetect = AirthingsWaveDetect(scan_interval, None)
+        self.airthingsdetect = AirthingsWaveDetect(scan_interval, None, max_concurrent=max_concurrent, gatt_cache=gatt_cache,
+                                                   keep_alive=keep_alive, read_every=read_every, adaptive=adaptive,
+                                                   advertisements=advertisements, transport=transport, metrics=metrics,
+                                                   adapters=adapters, device_adapters=device_adapters,
+                                                   failure_threshold=failure_threshold, probe_interval=probe_interval,
+                                                   connect_timeout=connect_timeout, read_timeout=read_timeout, cycle_timeout=cycle_timeout,
+                                                   polling=polling)
 
         # Note: Doing this so multiple mac addresses can be sent in instead of just one.
         if devices is not None and devices != {}:
@@ -71,6 +92,7 @@ class ATSensors:
         s += '  "refresh_interval": ' + str(CONFIG["refresh_interval"]) + ',\n'
         s += '  "retry_count": ' + str(CONFIG["retry_count"]) + ',\n'
         s += '  "retry_wait": ' + str(CONFIG["retry_wait"]) + ',\n'
+        s += '  "max_concurrent": ' + str(CONFIG["max_concurrent"]) + ',\n'
         s += '  "log_level": "' + CONFIG["log_level"] + '",\n'
         s += '  "mqtt_discovery": ' + str(CONFIG["mqtt_discovery"]).lower() + ',\n'
         s += '  "mqtt_retain": ' + str(CONFIG["mqtt_retain"]).lower() + ',\n'
@@ -147,10 +169,12 @@ class ATSensors:
             sys.exit(1)
 
     async def get_device_info(self):
-        _LOGGER.debug("Getting info about device(s)...")
+        _LOGGER.debug("Getting info about device(s) and their sensors...")
         for attempt in range(CONFIG["retry_count"]):
             try:
-                devices_info = await self.airthingsdetect.get_info()
+                # Reads the device info, finds the sensors and takes the first sensor reading
+                # using a single connection to each device.
+                devices_info = await self.airthingsdetect.onboard()
             except:
                 _LOGGER.warning("Unexpected exception while getting device information on attempt {}. Retrying in {} seconds.".format(attempt+1, CONFIG["retry_wait"]))
                 await asyncio.sleep(CONFIG["retry_wait"])
@@ -171,23 +195,8 @@ class ATSensors:
             DEVICES[mac]["device_name"] = dev.device_name
             DEVICES[mac]["firmware_rev"] = dev.firmware_rev
 
-        _LOGGER.debug("Getting sensors...")
-        for attempt in range(CONFIG["retry_count"]):
-            try:
-                devices_sensors = await self.airthingsdetect.get_sensors()
-            except:
-                _LOGGER.warning("Unexpected exception while getting sensors information on attempt {}. Retrying in {} seconds.".format(attempt+1, CONFIG["retry_wait"]))
-                await asyncio.sleep(CONFIG["retry_wait"])
-            else:
-                # Success!
-                break
-        else:
-            # We failed all attempts
-            _LOGGER.exception("Failed to get info from sensors after {} attempts.".format(CONFIG["retry_count"]))
-            return False
-
         # Collect sensor details
-        for mac, sensors in devices_sensors.items():
+        for mac, sensors in self.airthingsdetect.sensors.items():
             for sensor in sensors:
                 self.sensors_list.append([mac, sensor.uuid, sensor.handle])
                 _LOGGER.debug("{}: Found sensor UUID: {} Handle: {}".format(mac, sensor.uuid, sensor.handle))
@@ -213,20 +222,280 @@ class ATSensors:
         
         return True
 
-def mqtt_publish(msgs):
-    # Publish the sensor data to mqtt broker
+async def mqtt_connect():
+    # Open the long-lived session to the mqtt broker used for all messages.
+    global MQTT
+    if "mqtt_username" in CONFIG and CONFIG["mqtt_username"] != "" and "mqtt_password" in CONFIG and CONFIG["mqtt_password"] != "":
+        auth = {'username':CONFIG["mqtt_username"], 'password':CONFIG["mqtt_password"]}
+    else:
+        auth = None
+    MQTT = MQTTSession(CONFIG["mqtt_host"], CONFIG["mqtt_port"], client_id="airthings-mqtt", auth=auth, max_inflight=CONFIG["mqtt_max_inflight"])
+    if not await MQTT.connect():
+        _LOGGER.warning("Not yet connected to mqtt broker, sensor values will not be sent until the connection is made.")
+
+async def mqtt_publish(msgs):
+    # Publish the sensor data to mqtt broker. Returns True once the broker has the messages,
+    # False if it did not confirm them in time, in which case paho still sends them when it
+    # can, and None if they could not be handed to paho.
+    start = time.monotonic()
     try:
-        _LOGGER.info("Sending messages to mqtt broker...")
-        if "mqtt_username" in CONFIG and CONFIG["mqtt_username"] != "" and "mqtt_password" in CONFIG and CONFIG["mqtt_password"] != "":
-            auth = {'username':CONFIG["mqtt_username"], 'password':CONFIG["mqtt_password"]}
+        _LOGGER.debug("Sending messages to mqtt broker...")
+        if await MQTT.publish_multiple(msgs):
+            _LOGGER.debug("Done sending messages to mqtt broker.")
+            if METRICS is not None:
+                METRICS.mqtt_publish_seconds.observe(time.monotonic() - start)
+                METRICS.mqtt_messages.inc(len(msgs))
+            return True
         else:
-            auth = None
-        publish.multiple(msgs, hostname=CONFIG["mqtt_host"], port=CONFIG["mqtt_port"], client_id="airthings-mqtt", auth=auth)
-        _LOGGER.info("Done sending messages to mqtt broker.")
+            _LOGGER.error("Failed while sending messages to mqtt broker: timed out waiting for the broker, they are sent when it answers.")
+        if METRICS is not None:
+            METRICS.mqtt_publish_failures.inc()
+        return False
     except MQTTException as e:
         _LOGGER.error("Failed while sending messages to mqtt broker: {}".format(e))
     except:
         _LOGGER.exception("Unexpected exception while sending messages to mqtt broker.")
+    if METRICS is not None:
+        METRICS.mqtt_publish_failures.inc()
+    return None
+
+def discovery_message(mac, name):
+    # Create the HA mqtt discovery message for a sensor. These do not change while running,
+    # so each one is only created once.
+    if (mac, name) not in DISCOVERY:
+        if mac not in DISCOVERY:
+            # Create device details for this device
+            device = {}
+            device["connections"] = [["mac", mac]]
+            if "serial_nr" in DEVICES[mac]: device["identifiers"] = [DEVICES[mac]["serial_nr"]]
+            if "manufacturer" in DEVICES[mac]: device["manufacturer"] = DEVICES[mac]["manufacturer"]
+            if "device_name" in DEVICES[mac]: device["name"] = DEVICES[mac]["device_name"]
+            if "model_nr" in DEVICES[mac]: device["model"] = DEVICES[mac]["model_nr"]
+            if "firmware_rev" in DEVICES[mac]: device["sw_version"] = DEVICES[mac]["firmware_rev"]
+            DISCOVERY[mac] = device
+
+        config = {}
+        if "name" in DEVICES[mac]:
+            if name in SENSORS:
+                config["name"] = DEVICES[mac]["name"]+" "+SENSORS[name]["name"]
+                if SENSORS[name]["device_class"] != None: config["device_class"] = SENSORS[name]["device_class"]
+                if SENSORS[name]["icon"] != None: config["icon"] = SENSORS[name]["icon"]
+                if SENSORS[name]["state_class"] != None: config["state_class"] = SENSORS[name]["state_class"]
+                config["unit_of_measurement"] = SENSORS[name]["unit_of_measurement"]
+                config["uniq_id"] = mac+"_"+name
+                if CONFIG.get("mqtt_json_state"):
+                    # Each entity picks its value out of the device's json state document.
+                    config["state_topic"] = "airthings/"+mac+"/state"
+                    config["value_template"] = "{{ value_json."+name+" }}"
+                    config["json_attributes_topic"] = "airthings/"+mac+"/state"
+                    config["json_attributes_template"] = "{{ {'timestamp': value_json.timestamp} | tojson }}"
+                else:
+                    config["state_topic"] = "airthings/"+mac+"/"+name
+                config["device"] = DISCOVERY[mac]
+
+        DISCOVERY[(mac, name)] = {'topic': "homeassistant/sensor/airthings_"+mac.replace(":","")+"/"+name+"/config", 'payload': json.dumps(config), 'retain': True}
+    return DISCOVERY[(mac, name)]
+
+def discovery_messages(sensors, extra=None):
+    # Collect the HA mqtt discovery messages for any sensors that Home Assistant does not
+    # know about yet, or whose configuration has changed, with the hashes to remember once sent.
+    # extra holds any further values (such as aggregates) of each device.
+    msgs = []
+    hashes = {}
+    for mac, data in sensors.items():
+        names = list(data) + list(extra.get(mac, {})) if extra else data
+        # Consistent mac formatting
+        mac = mac.lower()
+        for name in names:
+            if name not in NOT_PUBLISHED:
+                try:
+                    msg = discovery_message(mac, name)
+                    h = hashlib.sha1(msg['payload'].encode()).hexdigest()
+                    if DISCOVERY_HASHES.get(msg['topic']) != h:
+                        msgs.append(msg)
+                        hashes[msg['topic']] = h
+                except:
+                    _LOGGER.exception("Failed while creating HA mqtt discovery messages.")
+    return msgs, hashes
+
+async def publish_device(mac, data, first, publish_filter=None, fresh=None):
+    # Send the readings of one device, and its HA mqtt discovery messages if Home Assistant
+    # does not know about its sensors yet or their configuration has changed. fresh holds the
+    # values just read, if not all of them were. Returns True if the readings were sent.
+    sensors = {mac: data}
+    extra = None
+    if AGGREGATES is not None:
+        extra = {mac: AGGREGATES.add(mac, getattr(data, "timestamp", time.time()), data, fresh)}
+
+    if not MQTT.is_connected:
+        # Do not wait for a broker that is not there, which would hold up the other devices
+        # and the next bluetooth reads. Keep the readings to send later if enabled, and send
+        # all values once the broker is back.
+        if BUFFER is not None:
+            buffer_readings(sensors)
+        else:
+            _LOGGER.warning("Not connected to mqtt broker, the readings of {} were not sent.".format(mac))
+        if publish_filter is not None: publish_filter.reset("airthings/"+mac.lower()+"/")
+        return False
+
+    if CONFIG["mqtt_discovery"] != False:
+        msgs, hashes = discovery_messages(sensors, extra)
+        if msgs:
+            # Publish the HA mqtt discovery data to mqtt broker
+            _LOGGER.info("Sending HA mqtt discovery configuration messages for {}...".format(mac))
+            if await mqtt_publish(msgs):
+                DISCOVERY_HASHES.update(hashes)
+                save_discovery_hashes()
+
+    msgs = sensor_messages(sensors, first, publish_filter, extra=extra)
+
+    # Publish the sensor data to mqtt broker. If that fails, keep the readings to send later
+    # and send all values once the broker is back.
+    sent = await mqtt_publish(msgs)
+    if not sent:
+        # Only keep the readings if paho does not have them, as otherwise it still sends them
+        # to the sensor topics itself.
+        if BUFFER is not None and sent is None:
+            buffer_readings(sensors)
+        if publish_filter is not None: publish_filter.reset("airthings/"+mac.lower()+"/")
+        return False
+    if BUFFER:
+        await drain_buffer()
+    return True
+
+async def publish_readings(queue, publish_filter=None):
+    # Send the readings put on the queue by AirthingsWaveDetect as each device is read. The
+    # first readings of a device also clear any retained values if "mqtt_retain" is not set.
+    published = set()
+    while True:
+        mac, data, fresh = await queue.get()
+        try:
+            if await publish_device(mac, data, mac not in published, publish_filter, fresh):
+                published.add(mac)
+        except:
+            _LOGGER.exception("Unexpected exception while sending the readings of {}.".format(mac))
+        finally:
+            queue.task_done()
+
+def format_value(name, val):
+    # Edit or format sensor data as needed. Aggregates are formatted like their sensor.
+    if AGGREGATES is not None:
+        name = AGGREGATES.sensors.get(name, name)
+    if isinstance(val, str) == False:
+        if name == "temperature":
+            val = round(val,1)
+        elif name == "battery":
+            val = max(0, min(100, round( (val-2.4)/(3.2-2.4)*100 ))) # Voltage is between 2.4 and 3.2
+        else:
+            val = round(val)
+    return val
+
+def sensor_messages(sensors, first=False, publish_filter=None, devices=None, extra=None):
+    # Create the mqtt messages for the sensor values, only for the given devices if set. If
+    # publish_filter is set, only values that it says have changed are included. extra holds
+    # any further values (such as aggregates) of each device.
+    msgs = []
+    for mac, data in sensors.items():
+        if devices is not None and mac not in devices:
+            continue
+        values = list(data.items()) + list(extra.get(mac, {}).items()) if extra else data.items()
+        # Consistent mac formatting
+        mac = mac.lower()
+        if CONFIG.get("mqtt_json_state"):
+            msgs.extend(state_messages(mac, data, first, publish_filter, values))
+            continue
+        for name, val in values:
+            if name not in NOT_PUBLISHED:
+                val = format_value(name, val)
+                if publish_filter is not None and not publish_filter.changed("airthings/"+mac+"/"+name, name, val):
+                    _LOGGER.debug("{} = {} (unchanged)".format("airthings/"+mac+"/"+name, val))
+                    continue
+                _LOGGER.info("{} = {}".format("airthings/"+mac+"/"+name, val))
+
+                # If this is a first run, clear any retained messages if "mqtt_retain" is not set in config.
+                if first and not CONFIG["mqtt_retain"]:
+                    _LOGGER.debug("Appending message to delete any existing retained message...")
+                    msgs.append({'topic': "airthings/"+mac+"/"+name, 'payload': '', 'retain': True})
+
+                msgs.append({'topic': "airthings/"+mac+"/"+name, 'payload': val, 'retain': CONFIG["mqtt_retain"]})
+    return msgs
+
+def state_messages(mac, data, first=False, publish_filter=None, values=None):
+    # Create the single json state message for a device when "mqtt_json_state" is set, with
+    # the values given or else those in data. With publish_filter, the whole document is sent
+    # if any of its values has changed.
+    topic = "airthings/"+mac+"/state"
+    values = {name: format_value(name, val) for name, val in (data.items() if values is None else values) if name not in NOT_PUBLISHED}
+    if publish_filter is not None:
+        changed = [name for name, val in values.items() if publish_filter.changed("airthings/"+mac+"/"+name, name, val)]
+        if not changed:
+            _LOGGER.debug("{} unchanged".format(topic))
+            return []
+    values["timestamp"] = round(getattr(data, "timestamp", time.time()), 3)
+    payload = json.dumps(values, separators=(",", ":"))
+    _LOGGER.info("{} = {}".format(topic, payload))
+
+    msgs = []
+    # If this is a first run, clear any retained message if "mqtt_retain" is not set in config.
+    if first and not CONFIG["mqtt_retain"]:
+        msgs.append({'topic': topic, 'payload': '', 'retain': True})
+    msgs.append({'topic': topic, 'payload': payload, 'retain': CONFIG["mqtt_retain"]})
+    return msgs
+
+def buffer_readings(sensors, devices=None):
+    # Keep the readings that could not be sent, with the time they were taken, until the mqtt
+    # broker is available again.
+    now = time.time()
+    for mac, data in sensors.items():
+        if devices is not None and mac not in devices:
+            continue
+        values = {name: format_value(name, val) for name, val in data.items() if name not in NOT_PUBLISHED and val is not None}
+        BUFFER.append(getattr(data, "timestamp", now), mac.lower(), values)
+    _LOGGER.warning("Kept the readings of {} device(s) to send once the mqtt broker is available.".format(len(sensors) if devices is None else len(devices)))
+
+async def drain_buffer():
+    # Send the buffered readings, oldest first, as json to airthings/<mac>/history. These are
+    # not sent to the sensor topics so that Home Assistant does not show old values as current.
+    sent = 0
+    while BUFFER and MQTT.is_connected:
+        readings, position = BUFFER.read_batch(CONFIG["buffer_batch_size"])
+        msgs = [{'topic': "airthings/"+r["mac"]+"/history", 'payload': json.dumps(dict(r["v"], timestamp=r["t"])), 'retain': False} for r in readings]
+        result = await mqtt_publish(msgs) if msgs else True
+        if result is None:
+            break
+        # Readings that timed out are still sent by paho, so they are not read again.
+        BUFFER.commit(position)
+        sent += len(msgs)
+        if not result:
+            break
+        # Let the bluetooth reads and everything else run between batches.
+        await asyncio.sleep(0)
+    if sent:
+        _LOGGER.info("Sent {} buffered reading(s).".format(sent))
+
+def load_discovery_hashes():
+    # Load the hashes of the HA mqtt discovery messages sent before the last restart.
+    try:
+        with open(CONFIG["discovery_cache"]) as f:
+            DISCOVERY_HASHES.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except:
+        _LOGGER.warning("Ignoring unreadable " + CONFIG["discovery_cache"] + " file.")
+
+def save_discovery_hashes():
+    try:
+        with open(CONFIG["discovery_cache"], "w") as f:
+            json.dump(DISCOVERY_HASHES, f)
+    except:
+        _LOGGER.warning("Could not write " + CONFIG["discovery_cache"] + " file.")
+
+def ha_status(payload):
+    # Home Assistant sends "online" when it starts, so send all discovery messages again in
+    # case the mqtt broker has lost them.
+    if payload == b"online":
+        _LOGGER.info("Home Assistant started, HA mqtt discovery configuration messages will be sent again.")
+        DISCOVERY_HASHES.clear()
 
 async def main():
     logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]', level=logging.INFO)
@@ -239,15 +508,40 @@ async def main():
     parser.add_argument('--refresh_interval', type=int, default=150, help='how many seconds to wait before next refresh of the sensor data (default is "150")')
     parser.add_argument('--retry_count', type=int, default=10, help='number of times to retry accessing your Airthings devices when there is a bluetooth error or other issue before exiting (default is "10")')
     parser.add_argument('--retry_wait', type=int, default=3, help='how many seconds to wait between the retries set out in retry-count (default is "3")')
+    parser.add_argument('--connect_timeout', type=int, default=30, help='how many seconds to wait for a connection to a device before giving up on that attempt (default is 30)')
+    parser.add_argument('--read_timeout', type=int, default=10, help='how many seconds to wait for any other bluetooth operation before giving up (default is 10)')
+    parser.add_argument('--cycle_timeout', type=int, default=0, help='how many seconds reading all devices may take, devices not read by then are read first next time, 0 for no limit (default is 0)')
+    parser.add_argument('--failure_threshold', type=int, default=5, help='number of failed reads in a row after which a device is only tried every probe_interval seconds, 0 disables this (default is 5)')
+    parser.add_argument('--probe_interval', type=int, default=900, help='how many seconds to wait between attempts to read a device that keeps failing (default is 900)')
+    parser.add_argument('--fast_interval', type=int, default=60, help='how many seconds between reads of a device that matches one of the poll_rules (default is 60)')
+    parser.add_argument('--slow_interval', type=int, default=0, help='with poll_rules, how many seconds between reads of a device that matches none of them, 0 to use refresh_interval (default is 0)')
+    parser.add_argument('--max_concurrent', type=int, default=1, help='maximum number of Airthings devices to connect to at the same time (default is "1")')
+    parser.add_argument('--adapters', type=str, default='', help='comma separated bluetooth adapters to spread the devices over, e.g. "hci0,hci1" (default is the default adapter)')
+    parser.add_argument('--keep_alive', type=str, default='False', choices=['True', 'False'], help='controls whether connections to the Airthings devices are kept open between refreshes (default is False)')
+    parser.add_argument('--adaptive_refresh', type=str, default='False', choices=['True', 'False'], help='controls whether each device is read just after it takes a new measurement instead of every refresh_interval (default is False)')
+    parser.add_argument('--advertisement_timeout', type=int, default=0, help='skip devices that have not been seen by a background bluetooth scan for this many seconds, 0 disables the scan (default is 0)')
     parser.add_argument('--log_level', type=str, default="INFO", choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO','DEBUG'], help='verbosity of log output (default is "INFO")')
     parser.add_argument('--mqtt_host', type=str, default='hass', help='mqtt server host name or ip address (default is "hass")')
     parser.add_argument('--mqtt_port', type=int, default=1883, help='mqtt server host port (default is 1883)')
     parser.add_argument('--mqtt_username', type=str, default='airthings', help='mqtt server username (default is "airthings")')
     parser.add_argument('--mqtt_password', type=str, default='secret', help='mqtt server password (default is "secret")')
+    parser.add_argument('--mqtt_max_inflight', type=int, default=20, help='maximum number of messages sent to the mqtt broker that have not yet been acknowledged (default is 20)')
+    parser.add_argument('--publish_changes_only', type=str, default='False', choices=['True', 'False'], help='controls whether sensor values are only sent to the mqtt broker when they change (default is False)')
+    parser.add_argument('--publish_heartbeat', type=int, default=3600, help='with publish_changes_only, how many seconds after which a sensor value is sent again even if it has not changed (default is 3600)')
+    parser.add_argument('--mqtt_json_state', type=str, default='False', choices=['True', 'False'], help='controls whether the sensor values of each device are sent as one json document to airthings/<mac>/state instead of one message per value (default is False)')
     parser.add_argument('--mqtt_discovery', type=str, default='True', choices=['True', 'False'], help='controls whether the Home Assistant\'s MQTT Discovery feature is enabled or disabled (default is True)')
     parser.add_argument('--mqtt_retain', type=str, default='False', choices=['True', 'False'], help='controls whether the "retain" flag is set for sensor values sent to the MQTT broker (default is False)')
     parser.add_argument('--addon', action='store_true', help='flag used internally if script is being run as an add-on (default is False)')
     parser.add_argument('--config', type=str, default='./options.json', help='location of config file (default is ./options.json)')
+    parser.add_argument('--gatt_cache', type=str, default=None, help='location of the file used to remember the sensors of each device, use "" to disable (default is gatt_cache.json next to the config file)')
+    parser.add_argument('--discovery_cache', type=str, default=None, help='location of the file used to remember which HA mqtt discovery messages have been sent (default is discovery_cache.json next to the config file)')
+    parser.add_argument('--buffer_size', type=int, default=0, help='megabytes of readings to keep on disk while the mqtt broker is unavailable, 0 disables the buffer (default is 0)')
+    parser.add_argument('--buffer_max_age', type=int, default=168, help='hours after which buffered readings that could not be sent are dropped (default is 168)')
+    parser.add_argument('--buffer_path', type=str, default=None, help='directory used to keep readings while the mqtt broker is unavailable (default is a buffer directory next to the config file)')
+    parser.add_argument('--metrics_port', type=int, default=0, help='port on which to serve metrics in the Prometheus format at /metrics, 0 disables them (default is 0)')
+    parser.add_argument('--simulate', type=int, default=0, help='use this many simulated Airthings devices instead of real ones, for testing (default is 0)')
+    parser.add_argument('--simulate_connect_latency', type=float, default=0.5, help='average time in seconds to connect to a simulated device (default is 0.5)')
+    parser.add_argument('--simulate_failure_rate', type=float, default=0.0, help='fraction of connections to simulated devices that fail (default is 0.0)')
     parser.add_argument('--generate_config', action='store_true', help='output to file a suggested config file (default is ./options.json)')
     args = parser.parse_args()
 
@@ -255,16 +549,46 @@ async def main():
     CONFIG["refresh_interval"] = args.refresh_interval
     CONFIG["retry_count"] = args.retry_count
     CONFIG["retry_wait"] = args.retry_wait
+    CONFIG["connect_timeout"] = args.connect_timeout
+    CONFIG["read_timeout"] = args.read_timeout
+    CONFIG["cycle_timeout"] = args.cycle_timeout
+    CONFIG["failure_threshold"] = args.failure_threshold
+    CONFIG["probe_interval"] = args.probe_interval
+    CONFIG["fast_interval"] = args.fast_interval
+    CONFIG["slow_interval"] = args.slow_interval
+    CONFIG["max_concurrent"] = args.max_concurrent
+    CONFIG["adapters"] = [a for a in args.adapters.split(",") if a != ""]
+    CONFIG["keep_alive"] = args.keep_alive == 'True'
+    CONFIG["adaptive_refresh"] = args.adaptive_refresh == 'True'
+    CONFIG["advertisement_timeout"] = args.advertisement_timeout
     CONFIG["log_level"] = args.log_level
     CONFIG["mqtt_host"] = args.mqtt_host
     CONFIG["mqtt_port"] = args.mqtt_port
     CONFIG["mqtt_username"] = args.mqtt_username
     CONFIG["mqtt_password"] = args.mqtt_password
+    CONFIG["mqtt_max_inflight"] = args.mqtt_max_inflight
+    CONFIG["publish_changes_only"] = args.publish_changes_only == 'True'
+    CONFIG["publish_heartbeat"] = args.publish_heartbeat
+    CONFIG["mqtt_json_state"] = args.mqtt_json_state == 'True'
     CONFIG["mqtt_discovery"] = args.mqtt_discovery == True
     CONFIG["mqtt_retain"] = args.mqtt_retain == True
     CONFIG["addon"] = args.addon
     CONFIG["config"] = args.config
     CONFIG["generate_config"] = args.generate_config
+    CONFIG["gatt_cache"] = args.gatt_cache
+    CONFIG["discovery_cache"] = args.discovery_cache
+    CONFIG["buffer_size"] = args.buffer_size
+    CONFIG["buffer_max_age"] = args.buffer_max_age
+    CONFIG["buffer_path"] = args.buffer_path
+    CONFIG["buffer_batch_size"] = 100
+    CONFIG["metrics_port"] = args.metrics_port
+    CONFIG["simulate"] = args.simulate
+    CONFIG["simulate_connect_latency"] = args.simulate_connect_latency
+    CONFIG["simulate_failure_rate"] = args.simulate_failure_rate
+    CONFIG["read_every"] = {}
+    CONFIG["publish_deadband"] = {}
+    CONFIG["aggregates"] = []
+    CONFIG["poll_rules"] = []
 
     if CONFIG["generate_config"]:
         if os.path.exists(CONFIG['config']):
@@ -299,10 +623,78 @@ async def main():
                     # Ensure consistent formatting for the mac address
                     d["mac"] = d["mac"].lower()
                     DEVICES[d["mac"].lower()] = {}
+                    if "name" in d: DEVICES[d["mac"]]["name"] = d["name"]
+                    if "adapter" in d: DEVICES[d["mac"]]["adapter"] = d["adapter"]
                 else:
                     _LOGGER.warning("Invalid mac address provided: {}".format(d["mac"]))
 
-    a = ATSensors(180, DEVICES)
+    # Set up the rolling-window aggregates, each sent as a sensor of its own.
+    global AGGREGATES
+    if CONFIG["aggregates"]:
+        try:
+            AGGREGATES = Aggregates(CONFIG["aggregates"])
+            for name, sensor in AGGREGATES.sensors.items():
+                if sensor in SENSORS:
+                    stat, window = name[len(sensor)+1:].split("_")
+                    SENSORS[name] = dict(SENSORS[sensor], name=SENSORS[sensor]["name"]+" ("+window+" "+stat+")")
+        except Exception as e:
+            _LOGGER.error("Invalid aggregates option, aggregates will not be sent: {}".format(e))
+            AGGREGATES = None
+
+    # Use a simulated fleet of devices, split between the models, instead of the configured ones.
+    transport = None
+    if CONFIG["simulate"] > 0:
+        n = CONFIG["simulate"]
+        transport = SimulatedTransport(wave_plus=n - 2 * (n // 3), wave2=n // 3, wave_mini=n // 3,
+                                       connect_latency=CONFIG["simulate_connect_latency"],
+                                       connect_failure_rate=CONFIG["simulate_failure_rate"])
+        _LOGGER.warning("Using {} simulated Airthings devices.".format(n))
+        DEVICES.clear()
+        for i, (mac, device) in enumerate(transport.devices.items()):
+            DEVICES[mac] = {"name": "Simulated {} {}".format(device.device_name, i + 1)}
+
+    # Set up the cache of discovered sensors, stored next to the config file by default.
+    if CONFIG["gatt_cache"] is None:
+        CONFIG["gatt_cache"] = os.path.join(os.path.dirname(os.path.abspath(CONFIG["config"])), "gatt_cache.json")
+    gatt_cache = GattCache(CONFIG["gatt_cache"]) if CONFIG["gatt_cache"] != "" else None
+
+    # Bluetooth adapters to spread the devices over, given by name or as {"name": ..., "max_concurrent": ...}.
+    adapters = {}
+    for adapter in CONFIG["adapters"]:
+        if isinstance(adapter, dict):
+            adapters[adapter["name"]] = adapter.get("max_concurrent")
+        else:
+            adapters[adapter] = None
+    device_adapters = {mac: d["adapter"] for mac, d in DEVICES.items() if "adapter" in d}
+    if adapters:
+        _LOGGER.info("Using bluetooth adapters: {}".format(", ".join(adapters)))
+
+    # Set up the background scan used to skip devices that are out of range.
+    advertisements = AdvertisementMonitor(CONFIG["advertisement_timeout"], transport=transport, adapters=list(adapters)) if CONFIG["advertisement_timeout"] > 0 else None
+
+    # Set up the rules used to read devices more often while their values need watching.
+    polling = None
+    if CONFIG["poll_rules"]:
+        try:
+            polling = PollingRules(CONFIG["poll_rules"], CONFIG["fast_interval"], CONFIG["slow_interval"] or None)
+        except Exception as e:
+            _LOGGER.error("Invalid poll_rules option, devices will be read every refresh_interval: {}".format(e))
+
+    # Serve metrics about the bluetooth and mqtt communication, if enabled.
+    global METRICS
+    if CONFIG["metrics_port"] > 0:
+        METRICS = BridgeMetrics()
+        try:
+            await MetricsServer(METRICS, CONFIG["metrics_port"]).start()
+        except:
+            _LOGGER.exception("Failed to start the metrics server on port {}.".format(CONFIG["metrics_port"]))
+
+    a = ATSensors(CONFIG["refresh_interval"], DEVICES, max_concurrent=CONFIG["max_concurrent"], gatt_cache=gatt_cache, keep_alive=CONFIG["keep_alive"],
+                  read_every=CONFIG["read_every"], adaptive=CONFIG["adaptive_refresh"], advertisements=advertisements,
+                  transport=transport, metrics=METRICS, adapters=adapters, device_adapters=device_adapters,
+                  failure_threshold=CONFIG["failure_threshold"], probe_interval=CONFIG["probe_interval"],
+                  connect_timeout=CONFIG["connect_timeout"], read_timeout=CONFIG["read_timeout"], cycle_timeout=CONFIG["cycle_timeout"],
+                  polling=polling)
     if DEVICES is None or DEVICES == {}:
         _LOGGER.info("No devices provided, so searching for Airthings sensors...")
         await a.find_devices()
@@ -312,92 +704,65 @@ async def main():
         _LOGGER.error("\033[31mFailed to set up Airthings sensors. If the watchdog option is enabled, this addon will restart and try again.\033[0m")
         sys.exit(1)
 
+    await mqtt_connect()
+
+    # Set up the buffer for readings taken while the mqtt broker is unavailable, if enabled.
+    global BUFFER
+    if CONFIG["buffer_size"] > 0:
+        if CONFIG["buffer_path"] is None:
+            CONFIG["buffer_path"] = os.path.join(os.path.dirname(os.path.abspath(CONFIG["config"])), "buffer")
+        try:
+            BUFFER = ReadingBuffer(CONFIG["buffer_path"], CONFIG["buffer_size"] * 1000000, CONFIG["buffer_max_age"] * 3600)
+        except:
+            _LOGGER.exception("Failed to set up the buffer in " + CONFIG["buffer_path"] + ", readings will not be kept while the mqtt broker is unavailable.")
+
+    if CONFIG["mqtt_discovery"] != False:
+        if CONFIG["discovery_cache"] is None:
+            CONFIG["discovery_cache"] = os.path.join(os.path.dirname(os.path.abspath(CONFIG["config"])), "discovery_cache.json")
+        load_discovery_hashes()
+        MQTT.subscribe("homeassistant/status", ha_status)
+
+    if advertisements is not None:
+        try:
+            await advertisements.start()
+        except:
+            _LOGGER.exception("Failed to start the background bluetooth scan, devices will not be skipped.")
+            a.airthingsdetect.advertisements = None
+
+    # Used to only send sensor values that have changed, if enabled.
+    publish_filter = PublishFilter(CONFIG["publish_deadband"], CONFIG["publish_heartbeat"]) if CONFIG["publish_changes_only"] else None
+
+    # The readings of each device are queued as soon as it has been read, and sent by a
+    # separate task while the other devices are still being read.
+    queue = asyncio.Queue()
+    asyncio.ensure_future(publish_readings(queue, publish_filter))
+    a.airthingsdetect.on_reading = lambda mac, data, fresh: queue.put_nowait((mac, data, fresh))
+
+    # Send the readings taken while setting up the devices.
+    sensors = a.airthingsdetect.sensordata
+    for mac, data in sensors.items():
+        queue.put_nowait((mac, data, None))
+
     # Update sensor values in accordance with the REFRESH_INTERVAL set.
-    first = True
     while True:
-        # Get sensor data
-        sensors = await a.get_sensor_data()
-        # Only connect to mqtt broker if we have data
-        if sensors is not None and sensors != {}:
-            # Variable to store mqtt messages
-            msgs = []
-            
-            # Send HA mqtt discovery messages to broker on first run
-            if first and CONFIG["mqtt_discovery"] != False:
-                _LOGGER.info("Sending HA mqtt discovery configuration messages...")
-                for mac, data in sensors.items():
-                    # Consistent mac formatting
-                    mac = mac.lower()
-
-                    # Create device details for this device
-                    device = {}
-                    device["connections"] = [["mac", mac]]
-                    if "serial_nr" in DEVICES[mac]: device["identifiers"] = [DEVICES[mac]["serial_nr"]]
-                    if "manufacturer" in DEVICES[mac]: device["manufacturer"] = DEVICES[mac]["manufacturer"]
-                    if "device_name" in DEVICES[mac]: device["name"] = DEVICES[mac]["device_name"]
-                    if "model_nr" in DEVICES[mac]: device["model"] = DEVICES[mac]["model_nr"]
-                    if "firmware_rev" in DEVICES[mac]: device["sw_version"] = DEVICES[mac]["firmware_rev"]
-
-                    for name, val in data.items():
-                        if name != "date_time":                         
-                            try:
-                                config = {}
-                                s = next((item for item in CONFIG["devices"] if item["mac"] == mac), None)
-                                if s != None:
-                                    if name in SENSORS:
-                                        config["name"] = s["name"]+" "+SENSORS[name]["name"]
-                                        if SENSORS[name]["device_class"] != None: config["device_class"] = SENSORS[name]["device_class"]
-                                        if SENSORS[name]["icon"] != None: config["icon"] = SENSORS[name]["icon"]
-                                        if SENSORS[name]["state_class"] != None: config["state_class"] = SENSORS[name]["state_class"]
-                                        config["unit_of_measurement"] = SENSORS[name]["unit_of_measurement"]
-                                        config["uniq_id"] = mac+"_"+name
-                                        config["state_topic"] = "airthings/"+mac+"/"+name
-                                        config["device"] = device
-
-                                msgs.append({'topic': "homeassistant/sensor/airthings_"+mac.replace(":","")+"/"+name+"/config", 'payload': json.dumps(config), 'retain': True})
-                            except:
-                                _LOGGER.exception("Failed while creating HA mqtt discovery messages.")
-                
-                # Publish the HA mqtt discovery data to mqtt broker
-                mqtt_publish(msgs)
-                _LOGGER.info("Done sending HA mqtt discovery configuration messages.")
-                msgs = []
-                await asyncio.sleep(5)
-            
-            # Collect all of the sensor data
-            _LOGGER.info("Collecting sensor value messages...")
-            for mac, data in sensors.items():
-                for name, val in data.items():
-                    if name != "date_time":
-                        # Consistent mac formatting
-                        mac = mac.lower()
-                        if isinstance(val, str) == False:
-                            # Edit or format sensor data as needed
-                            if name == "temperature":
-                                val = round(val,1)
-                            elif name == "battery":
-                                val = max(0, min(100, round( (val-2.4)/(3.2-2.4)*100 ))) # Voltage is between 2.4 and 3.2
-                            else:
-                                val = round(val)
-                        _LOGGER.info("{} = {}".format("airthings/"+mac+"/"+name, val))
-                        
-                        # If this is a first run, clear any retained messages if "mqtt_retain" is not set in config.
-                        if first and not CONFIG["mqtt_retain"]:
-                            _LOGGER.debug("Appending message to delete any existing retained message...")
-                            msgs.append({'topic': "airthings/"+mac+"/"+name, 'payload': '', 'retain': True})
-                        
-                        msgs.append({'topic': "airthings/"+mac+"/"+name, 'payload': val, 'retain': CONFIG["mqtt_retain"]})
-            
-            # Publish the sensor data to mqtt broker
-            mqtt_publish(msgs)
-            first = False
-        else:
+        # Only carry on if we have data
+        if sensors is None or sensors is False or sensors == {}:
             _LOGGER.error("\033[31mNo sensor values collected. Please check your configuration and make sure your bluetooth adapter is available. If the watchdog option is enabled, this addon will restart and try again.\033[0m")
             sys.exit(1)
 
-        # Wait for next refresh cycle
-        _LOGGER.info("Waiting {} seconds.".format(CONFIG["refresh_interval"]))
-        await asyncio.sleep(CONFIG["refresh_interval"])
+        # Wait until everything read so far has been sent.
+        await queue.join()
+
+        # Wait for next refresh cycle, or until the next device is due with adaptive refresh,
+        # poll rules or when a device was skipped because of its signal.
+        wait = CONFIG["refresh_interval"]
+        if CONFIG["adaptive_refresh"] or a.airthingsdetect.advertisements is not None or polling is not None:
+            wait = min(wait, max(1, round(a.airthingsdetect.next_poll_time() - time.monotonic())))
+        _LOGGER.info("Waiting {} seconds.".format(wait))
+        await asyncio.sleep(wait)
+
+        # Get sensor data. Only the devices read are sent, as each one is done.
+        sensors = await a.get_sensor_data()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
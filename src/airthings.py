@@ -20,7 +20,9 @@
 
 import struct
 import time
-from collections import namedtuple
+import json
+import os
+from collections import deque, namedtuple
 
 import logging
 from datetime import datetime
@@ -83,79 +85,188 @@ sensors_characteristics_uuid = [CHAR_UUID_DATETIME, CHAR_UUID_TEMPERATURE, CHAR_
 
 sensors_characteristics_uuid_str = [str(x) for x in sensors_characteristics_uuid]
 
+CachedCharacteristic = namedtuple('CachedCharacteristic', ['uuid', 'handle'])
+
+
+class GattCache:
+    """Sensor characteristics and their handles for each device, saved to disk so they do not
+    have to be discovered again on every start. Entries are only valid for the firmware
+    revision they were discovered with."""
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        try:
+            with open(self.path) as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            _LOGGER.warning("Ignoring unreadable GATT cache {}: {}".format(self.path, e))
+
+    def get(self, mac, firmware_rev):
+        entry = self._entries.get(mac.lower())
+        if entry is None or entry["firmware_rev"] != firmware_rev:
+            return None
+        return [CachedCharacteristic(uuid, handle) for uuid, handle in entry["characteristics"]]
+
+    def put(self, mac, firmware_rev, characteristics):
+        self._entries[mac.lower()] = {"firmware_rev": firmware_rev,
+                                      "characteristics": [[str(c.uuid), c.handle] for c in characteristics]}
+        self.save()
+
+    def invalidate(self, mac):
+        if self._entries.pop(mac.lower(), None) is not None:
+            self.save()
+
+    def save(self):
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            _LOGGER.warning("Could not write GATT cache {}: {}".format(self.path, e))
+
+
+class Reading:
+    """Sensor values read from a device, kept in a fixed set of slots rather than a dict so
+    that a process running for months does not keep allocating dicts and strings.
+
+    timestamp is when the values were read, in seconds since the epoch, and monotonic the
+    same moment as time.monotonic(). device_time is the device's own clock (epoch seconds)
+    when it was read. Values that were not read are None and are left out when the reading
+    is used like the dicts used before (items(), [], get(), in and update()).
+    """
+
+    FIELDS = ("humidity", "radon_1day_avg", "radon_longterm_avg", "temperature", "rel_atm_pressure", "co2", "voc",
+              "illuminance", "accelerometer", "battery", "measurement_periods")
+    __slots__ = FIELDS + ("timestamp", "monotonic", "device_time")
+
+    def __init__(self, timestamp=None, monotonic=None, **values):
+        # Slots that are never set read as None through getattr(), so the values are only
+        # set here when given. This keeps creating a reading cheap.
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.monotonic = time.monotonic() if monotonic is None else monotonic
+        for name, value in values.items():
+            self[name] = value
+
+    def __getattr__(self, name):
+        # Only called for slots that have not been set.
+        if name in Reading.__slots__:
+            return None
+        raise AttributeError(name)
+
+    def keys(self):
+        return [name for name in self.FIELDS if getattr(self, name) is not None]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.FIELDS if getattr(self, name) is not None]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __bool__(self):
+        return any(getattr(self, name) is not None for name in self.FIELDS)
+
+    def __contains__(self, name):
+        return name in self.FIELDS and getattr(self, name) is not None
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in self.FIELDS:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in self else default
+
+    def update(self, other):
+        # Take over the values in other, a Reading or a dict, along with its timestamps.
+        for name, value in other.items():
+            self[name] = value
+        if isinstance(other, Reading):
+            self.timestamp = other.timestamp
+            self.monotonic = other.monotonic
+            if other.device_time is not None:
+                self.device_time = other.device_time
+
+    def __repr__(self):
+        return "Reading({})".format(", ".join("{}={}".format(name, value) for name, value in self.items()))
+
 
 class BaseDecode:
     def __init__(self, name, format_type, scale):
         self.name = name
         self.format_type = format_type
         self.scale = scale
+        # Compiled once, and unpacked straight from the buffer received without copying it.
+        self._struct = struct.Struct(format_type)
 
-    def decode_data(self, raw_data):
-        val = struct.unpack(
-            self.format_type,
-            raw_data)
-        if len(val) == 1:
-            res = val[0] * self.scale
-        else:
-            res = val
-        return {self.name:res}
+    @property
+    def size(self):
+        return self._struct.size
+
+    def unpack(self, raw_data, offset=0):
+        return self._struct.unpack_from(raw_data, offset)
+
+    def decode_into(self, reading, raw_data):
+        # Set the values in raw_data on reading.
+        reading[self.name] = self.unpack(raw_data)[0] * self.scale
+
+    def decode_data(self, raw_data, timestamp=None):
+        reading = Reading(timestamp)
+        self.decode_into(reading, raw_data)
+        return reading
 
 
 class WavePlussDecode(BaseDecode):
-    def decode_data(self, raw_data):
-        val = super().decode_data(raw_data)
-        val = val[self.name]
-        data = {}
-        data['date_time'] = str(datetime.isoformat(datetime.now()))
-        data['humidity'] = val[1]/2.0
-        data['radon_1day_avg'] = val[4] if 0 <= val[4] <= 16383 else None
-        data['radon_longterm_avg'] = val[5] if 0 <= val[5] <= 16383 else None
-        data['temperature'] = val[6]/100.0
-        data['rel_atm_pressure'] = val[7]/50.0
-        data['co2'] = val[8]*1.0
-        data['voc'] = val[9]*1.0
-        return data
+    def decode_into(self, reading, raw_data):
+        val = self.unpack(raw_data)
+        reading.humidity = val[1]/2.0
+        reading.radon_1day_avg = val[4] if 0 <= val[4] <= 16383 else None
+        reading.radon_longterm_avg = val[5] if 0 <= val[5] <= 16383 else None
+        reading.temperature = val[6]/100.0
+        reading.rel_atm_pressure = val[7]/50.0
+        reading.co2 = val[8]*1.0
+        reading.voc = val[9]*1.0
 
 
 class Wave2Decode(BaseDecode):
-    def decode_data(self, raw_data):
-        val = super().decode_data(raw_data)
-        val = val[self.name]
-        data = {}
-        data['date_time'] = str(datetime.isoformat(datetime.now()))
-        data['humidity'] = val[1]/2.0
-        data['radon_1day_avg'] = val[4] if 0 <= val[4] <= 16383 else None
-        data['radon_longterm_avg'] = val[5] if 0 <= val[5] <= 16383 else None
-        data['temperature'] = val[6]/100.0
-        return data
+    def decode_into(self, reading, raw_data):
+        val = self.unpack(raw_data)
+        reading.humidity = val[1]/2.0
+        reading.radon_1day_avg = val[4] if 0 <= val[4] <= 16383 else None
+        reading.radon_longterm_avg = val[5] if 0 <= val[5] <= 16383 else None
+        reading.temperature = val[6]/100.0
 
 
 class WaveMiniDecode(BaseDecode):
-    def decode_data(self, raw_data):
-        val = super().decode_data(raw_data)
-        val = val[self.name]
-        data = {}
-        data['date_time'] = str(datetime.isoformat(datetime.now()))
-        data['temperature'] = round( val[1]/100.0 - 273.15,2)
-        data['humidity'] = val[3]/100.0
-        data['voc'] = val[4]*1.0
-        return data
+    def decode_into(self, reading, raw_data):
+        val = self.unpack(raw_data)
+        reading.temperature = round( val[1]/100.0 - 273.15,2)
+        reading.humidity = val[3]/100.0
+        reading.voc = val[4]*1.0
 
 
 class WaveDecodeDate(BaseDecode):
-    def decode_data(self, raw_data):
-        val = super().decode_data(raw_data)[self.name]
-        data = {self.name:str(datetime(val[0], val[1], val[2], val[3], val[4], val[5]).isoformat())}
-        return data
+    def decode_into(self, reading, raw_data):
+        val = self.unpack(raw_data)
+        reading.device_time = datetime(val[0], val[1], val[2], val[3], val[4], val[5]).timestamp()
 
 
 class WaveDecodeIluminAccel(BaseDecode):
-    def decode_data(self, raw_data):
-        val = super().decode_data(raw_data)[self.name]
-        data = {}
-        data['illuminance'] = str(val[0] * self.scale)
-        data['accelerometer'] = str(val[1] * self.scale)
-        return data
+    def decode_into(self, reading, raw_data):
+        val = self.unpack(raw_data)
+        reading.illuminance = str(val[0] * self.scale)
+        reading.accelerometer = str(val[1] * self.scale)
 
 
 class CommandDecode:
@@ -163,27 +274,27 @@ class CommandDecode:
         self.name = name
         self.format_type = format_type
         self.cmd = cmd
+        self._struct = struct.Struct(format_type)
 
-    def decode_data(self, raw_data):
+    def decode_into(self, reading, raw_data):
         if raw_data is None:
-            return {}
-        cmd = raw_data[0:1]
-        if cmd != self.cmd:
-            _LOGGER.warning("Result for Wrong command received, expected {} got {}".format(self.cmd.hex(), cmd.hex()))
-            return {}
-        
-        if len(raw_data[2:]) != struct.calcsize(self.format_type):
-            _LOGGER.debug("Wrong length data received ({}) verses expected ({})".format(len(cmd), struct.calcsize(self.format_type)))
-            return {}
-        val = struct.unpack(
-            self.format_type,
-            raw_data[2:])
-        res = {}
-        res['illuminance'] = val[2]
-        #res['measurement_periods'] =  val[5]
-        res['battery'] = val[17] / 1000.0
-
-        return res
+            return
+        if raw_data[0] != self.cmd[0]:
+            _LOGGER.warning("Result for Wrong command received, expected {} got {}".format(self.cmd.hex(), bytes(raw_data[0:1]).hex()))
+            return
+
+        if len(raw_data) - 2 != self._struct.size:
+            _LOGGER.debug("Wrong length data received ({}) verses expected ({})".format(len(raw_data) - 2, self._struct.size))
+            return
+        val = self._struct.unpack_from(raw_data, 2)
+        reading.illuminance = val[2]
+        reading.measurement_periods = val[5]
+        reading.battery = val[17] / 1000.0
+
+    def decode_data(self, raw_data, timestamp=None):
+        reading = Reading(timestamp)
+        self.decode_into(reading, raw_data)
+        return reading
 
 sensor_decoders = {str(CHAR_UUID_WAVE_PLUS_DATA):WavePlussDecode(name="Pluss", format_type='BBBBHHHHHHHH', scale=0),
                    str(CHAR_UUID_DATETIME):WaveDecodeDate(name="date_time", format_type='HBBBBB', scale=0),
@@ -198,171 +309,1031 @@ sensor_decoders = {str(CHAR_UUID_WAVE_PLUS_DATA):WavePlussDecode(name="Pluss", f
 command_decoders = {str(COMMAND_UUID):CommandDecode(name="Battery", format_type='<L12B6H', cmd=struct.pack('<B', 0x6d))}
 
 
+class DecoderRegistry:
+    """Finds the decoder for a characteristic from its UUID, given either as a UUID or a
+    string, or from its handle once the characteristics of a device have been bound. Frames
+    can be decoded one at a time, as a batch, or in bulk from recorded data."""
+
+    def __init__(self, sensor_decoders, command_decoders):
+        self._decoders = {}
+        self._commands = set()
+        for uuid, decoder in sensor_decoders.items():
+            self._decoders[uuid] = self._decoders[UUID(uuid)] = decoder
+        for uuid, decoder in command_decoders.items():
+            self._decoders[uuid] = self._decoders[UUID(uuid)] = decoder
+            self._commands.add(decoder)
+        self._handles = {}
+
+    def get(self, uuid):
+        # Returns the decoder for a UUID, a UUID string or a characteristic, or None.
+        return self._decoders.get(getattr(uuid, "uuid", uuid))
+
+    def is_command(self, decoder):
+        return decoder in self._commands
+
+    def bind(self, mac, characteristics):
+        # Remember the decoders for the handles of a device's characteristics.
+        handles = {}
+        for c in characteristics:
+            decoder = self.get(c)
+            if decoder is not None:
+                handles[c.handle] = decoder
+        self._handles[mac] = handles
+        return handles
+
+    def for_handle(self, mac, handle):
+        return self._handles.get(mac, {}).get(handle)
+
+    def _decoder(self, key, mac=None):
+        decoder = self.for_handle(mac, key) if isinstance(key, int) else self.get(key)
+        if decoder is None:
+            raise KeyError("No decoder for {}".format(key))
+        return decoder
+
+    def decode(self, key, raw_data, mac=None, timestamp=None):
+        # Decode a frame for a characteristic given by UUID, or by handle together with mac.
+        return self._decoder(key, mac).decode_data(raw_data, timestamp)
+
+    def decode_batch(self, frames, mac=None, timestamp=None):
+        # Decode (key, raw_data) pairs read at the same time into one Reading.
+        reading = Reading(timestamp)
+        for key, raw_data in frames:
+            self._decoder(key, mac).decode_into(reading, raw_data)
+        return reading
+
+    def decode_recorded(self, uuid, buffer, timestamp=None):
+        # Decode frames of one characteristic recorded back to back in buffer, without
+        # copying them. Yields the sensor values of each frame in turn.
+        decoder = self.get(uuid)
+        if decoder is None or self.is_command(decoder):
+            raise KeyError("No decoder for recorded {} data".format(uuid))
+        timestamp = time.time() if timestamp is None else timestamp
+        view = memoryview(buffer)
+        for offset in range(0, len(view) - decoder.size + 1, decoder.size):
+            yield decoder.decode_data(view[offset:offset + decoder.size], timestamp)
+
+decoders = DecoderRegistry(sensor_decoders, command_decoders)
+
+# Characteristics holding several sensor values at once, and the single value characteristics
+# that they make redundant. The command characteristic also reports the illuminance.
+packed_characteristics = {str(CHAR_UUID_WAVE_PLUS_DATA):[CHAR_UUID_TEMPERATURE, CHAR_UUID_HUMIDITY,
+                                                         CHAR_UUID_RADON_1DAYAVG, CHAR_UUID_RADON_LONG_TERM_AVG],
+                          str(CHAR_UUID_WAVE_2_DATA):[CHAR_UUID_TEMPERATURE, CHAR_UUID_HUMIDITY,
+                                                      CHAR_UUID_RADON_1DAYAVG, CHAR_UUID_RADON_LONG_TERM_AVG],
+                          str(CHAR_UUID_WAVEMINI_DATA):[CHAR_UUID_TEMPERATURE, CHAR_UUID_HUMIDITY],
+                          str(COMMAND_UUID):[CHAR_UUID_ILLUMINANCE_ACCELEROMETER]}
+
+# Characteristics to read for known models (Wave Plus, Wave gen 2 and Wave Mini). The
+# packed characteristics do not include the device clock, so it is read on its own.
+model_read_plans = {"2930":[str(CHAR_UUID_WAVE_PLUS_DATA), str(COMMAND_UUID), str(CHAR_UUID_DATETIME)],
+                    "2950":[str(CHAR_UUID_WAVE_2_DATA), str(CHAR_UUID_DATETIME)],
+                    "2920":[str(CHAR_UUID_WAVEMINI_DATA), str(CHAR_UUID_DATETIME)]}
+
+# The device clock hardly needs checking, so by default it is only read every 60th reading.
+default_read_every = {"date_time": 60}
+
+
+def model_from_advertisement(manufacturer_data):
+    # Airthings devices advertise their serial number under the Airthings company id (820),
+    # and the first 4 digits of the serial number are the model number. Returns the
+    # (serial_nr, model_nr) strings, or None if this is not an Airthings advertisement.
+    data = manufacturer_data.get(820)
+    if data is None:
+        return None
+    if len(data) < 4:
+        return "", ""
+    serial_nr = str(struct.unpack_from('<L', data)[0])
+    return serial_nr, serial_nr[:4]
+
+
+def build_read_plan(characteristics, model_nr=None):
+    # Pick the smallest set of characteristics that still gives every sensor value, using
+    # the plan for the model if it is known and otherwise the characteristics found.
+    if model_nr in model_read_plans:
+        plan = [c for c in characteristics if str(c.uuid) in model_read_plans[model_nr]]
+        if plan:
+            return plan
+
+    found = set(str(c.uuid) for c in characteristics)
+    redundant = set()
+    for uuid, covers in packed_characteristics.items():
+        if uuid in found:
+            redundant.update(str(x) for x in covers)
+    return [c for c in characteristics if str(c.uuid) not in redundant]
+
+
+class MeasurementSchedule:
+    """Learns when a device takes its measurements so it can be read just after each one.
+
+    New measurements are spotted from the device's measurement counter (or from its values
+    changing if the counter was not read). Each one is known to have happened between the
+    previous reading and the reading that spotted it. Every pair of these windows bounds the
+    measurement period, as the measurements they saw are a known number of periods apart,
+    and lining the windows up with that period narrows down when the last measurement was.
+    While that is still uncertain, the device is read in the middle of the time the next
+    measurement is expected in, halving the uncertainty with each reading.
+    """
+
+    WINDOWS = 16
+
+    def __init__(self, period=300, margin=10, retry=15):
+        self.period = period
+        self.margin = margin
+        self.retry = retry
+        self._default_period = period
+        self._last_poll = None
+        self._counter = None
+        self._values = {}
+        self._windows = deque()  # (earliest, latest, total measurements seen), oldest first
+        self._window = None     # (earliest, latest) time of the last measurement
+        self._steps = 0
+        self._unchanged = 0     # readings in a row without a new measurement
+
+    def update(self, now, counter=None, values=None):
+        # Record a reading taken at now, with the measurement counter if it was read.
+        values = values or {}
+        if counter is not None and self._counter is not None:
+            steps = (counter - self._counter) % 256
+        else:
+            steps = 1 if any(self._values.get(k, v) != v for k, v in values.items()) else 0
+        changed = self._last_poll is not None and steps > 0
+        self._unchanged = 0 if changed or self._last_poll is None else self._unchanged + 1
+
+        if changed:
+            self._steps += steps
+            self._windows.append((self._last_poll, now, self._steps))
+            if len(self._windows) > self.WINDOWS:
+                # Keep the narrowest windows, which say the most, and the latest one.
+                del self._windows[max(range(len(self._windows) - 1), key=lambda i: self._windows[i][1] - self._windows[i][0])]
+            self._fit()
+
+        self._last_poll = now
+        self._counter = counter
+        self._values.update(values)
+
+    def _fit(self):
+        # Work out the period and the window of the last measurement from the recent windows.
+        period = self._fit_period()
+        if period is not None:
+            self.period = min(max(period, self._default_period / 2), self._default_period * 2)
+        earliest, latest, steps = self._windows[-1]
+        window = (max(e + (steps - s) * self.period for e, l, s in self._windows),
+                  min(l + (steps - s) * self.period for e, l, s in self._windows))
+        # If the windows do not quite line up, only the latest one is certain.
+        self._window = window if window[0] <= window[1] else (earliest, latest)
+
+    def _fit_period(self):
+        # Returns the middle of the periods allowed by every pair of windows, or None if the
+        # windows span too few measurements. Windows that do not fit the newer ones, for
+        # example after a measurement was missed, are dropped.
+        while len(self._windows) > 1 and self._windows[-1][2] - self._windows[0][2] >= 3:
+            low, high = 0, float("inf")
+            windows = list(self._windows)
+            for i, (earliest, latest, steps) in enumerate(windows):
+                for later_earliest, later_latest, later_steps in windows[i + 1:]:
+                    low = max(low, (later_earliest - latest) / (later_steps - steps))
+                    high = min(high, (later_latest - earliest) / (later_steps - steps))
+            if low <= high:
+                return (low + high) / 2
+            self._windows.popleft()
+        return None
+
+    def _backoff(self, delay, fallback):
+        # Doubles delay for every reading in a row that found no new measurement, as a
+        # measurement can leave the values unchanged when the counter is not read.
+        return min(fallback, delay * 2 ** min(max(0, self._unchanged - 1), 16))
+
+    def next_poll(self, now, fallback):
+        # Returns the time at which the device should be read next. Retries are never more
+        # than fallback seconds apart.
+        if self._window is None:
+            # Still learning when the device takes its measurements, so check more often.
+            return now + self._backoff(self.period / 4, fallback)
+        # The next measurement is expected a period after the last one, but not before the
+        # last reading, which did not see it yet.
+        earliest = max(self._window[0] + self.period, self._last_poll)
+        latest = self._window[1] + self.period
+        if earliest > latest:
+            # Later than expected, so the period or the window was off.
+            return now + self._backoff(self.retry, fallback)
+        if latest - earliest > self.margin:
+            return max(now, (earliest + latest) / 2)
+        return max(now, latest + self.margin)
+
+
+class PollingRules:
+    """Reads devices more often while their values need watching, and less often otherwise.
+
+    Each rule is a dict with the sensor and one of "above" or "below" (a threshold) or
+    "rising" or "falling" (a change per hour, worked out over the last slope_window
+    seconds), e.g. {"sensor": "co2", "above": 1000} or {"sensor": "co2", "rising": 200}.
+    A device that matches any rule is read every fast_interval seconds until it no longer
+    does, and the other devices every slow_interval seconds (the normal interval if None).
+    """
+
+    KINDS = ("above", "below", "rising", "falling")
+
+    def __init__(self, rules, fast_interval=60, slow_interval=None, slope_window=900):
+        self.rules = []
+        for rule in rules:
+            kinds = [k for k in self.KINDS if k in rule]
+            if "sensor" not in rule or len(kinds) != 1:
+                raise ValueError("Invalid polling rule {}, it needs a sensor and one of {}".format(rule, ", ".join(self.KINDS)))
+            self.rules.append((rule["sensor"], kinds[0], float(rule[kinds[0]])))
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.slope_window = slope_window
+        self.fast = set()
+        self._history = {}
+
+    def _slope(self, mac, sensor, now, value):
+        # Change per hour over the last slope_window seconds, or None if not known yet.
+        history = self._history.setdefault((mac, sensor), [])
+        if not history or history[-1][0] != now:
+            history.append((now, value))
+        while len(history) > 2 and history[1][0] <= now - self.slope_window:
+            del history[0]
+        t, v = history[0]
+        if now - t < self.slope_window / 4:
+            return None
+        return (value - v) / (now - t) * 3600
+
+    def _matches(self, mac, sensor, kind, limit, now, value):
+        if kind == "above":
+            return value > limit
+        if kind == "below":
+            return value < limit
+        slope = self._slope(mac, sensor, now, value)
+        if slope is None:
+            return False
+        return slope > limit if kind == "rising" else slope < -limit
+
+    def update(self, mac, sensor_data):
+        # Check the latest values of a device, returns True if it is to be read fast.
+        now = getattr(sensor_data, "monotonic", None)
+        if now is None:
+            now = time.monotonic()
+        matched = None
+        for sensor, kind, limit in self.rules:
+            value = sensor_data.get(sensor)
+            if not isinstance(value, (int, float)):
+                continue
+            if self._matches(mac, sensor, kind, limit, now, value) and matched is None:
+                matched = "{} {} {}".format(sensor, kind, limit)
+        if matched is not None and mac not in self.fast:
+            _LOGGER.info("{}: {}, reading every {} seconds".format(mac, matched, self.fast_interval))
+            self.fast.add(mac)
+        elif matched is None and mac in self.fast:
+            _LOGGER.info("{}: back to normal".format(mac))
+            self.fast.discard(mac)
+        return matched is not None
+
+
+class BleakTransport:
+    """Creates the bleak clients and scanners used to talk to real devices. Another transport,
+    such as simulator.SimulatedTransport, can be given to AirthingsWaveDetect instead."""
+
+    # The adapter (e.g. "hci1") is only passed on when set, so the default adapter is used
+    # otherwise, as before.
+
+    def client(self, mac, disconnected_callback=None, adapter=None):
+        kwargs = {"adapter": adapter} if adapter is not None else {}
+        return BleakClient(mac.lower(), disconnected_callback=disconnected_callback, **kwargs)
+
+    def scanner(self, detection_callback=None, adapter=None):
+        kwargs = {"adapter": adapter} if adapter is not None else {}
+        return BleakScanner(detection_callback=detection_callback, **kwargs)
+
+
+class AdvertisementMonitor:
+    """Keeps a BleakScanner running in the background to record when each Airthings device
+    was last seen and how strong its signal was, so devices that are out of range or have a
+    weak signal at the moment can be skipped instead of failing to connect. With several
+    adapters a scanner runs on each of them, and the smoothed signal strength seen by each
+    adapter is used to pick the adapter closest to a device."""
+
+    def __init__(self, max_age=60, rssi_margin=10, transport=None, adapters=None):
+        self.transport = transport if transport is not None else BleakTransport()
+        self.max_age = max_age
+        self.rssi_margin = rssi_margin
+        self.adapters = list(adapters) if adapters else [None]
+        self.last_seen = {}
+        self.rssi = {}
+        self.rssi_avg = {}
+        self.adapter_rssi = {}
+        self._started = None
+        self._scanners = []
+
+    def _detection_callback(self, device, advertisement_data, adapter=None):
+        if 820 not in advertisement_data.manufacturer_data:
+            return
+        mac = device.address.lower()
+        rssi = advertisement_data.rssi
+        self.last_seen[mac] = time.monotonic()
+        self.rssi[mac] = rssi
+        # Smoothed signal strength to compare the latest one against.
+        avg = self.rssi_avg.get(mac)
+        self.rssi_avg[mac] = rssi if avg is None else avg + (rssi - avg) / 10.0
+        if adapter is not None:
+            adapters = self.adapter_rssi.setdefault(mac, {})
+            avg = adapters.get(adapter)
+            adapters[adapter] = rssi if avg is None else avg + (rssi - avg) / 10.0
+
+    async def start(self):
+        _LOGGER.debug("Starting background scan for airthings devices")
+        for adapter in self.adapters:
+            callback = lambda device, advertisement_data, adapter=adapter: self._detection_callback(device, advertisement_data, adapter)
+            scanner = self.transport.scanner(detection_callback=callback, adapter=adapter)
+            await scanner.start()
+            self._scanners.append(scanner)
+        self._started = time.monotonic()
+
+    async def stop(self):
+        for scanner in self._scanners:
+            await scanner.stop()
+        self._scanners = []
+
+    def seen_recently(self, mac, now=None):
+        now = time.monotonic() if now is None else now
+        if self._started is None or now - self._started < self.max_age:
+            # Not scanning for long enough to know.
+            return True
+        last_seen = self.last_seen.get(mac.lower())
+        return last_seen is not None and now - last_seen <= self.max_age
+
+    def weak_signal(self, mac):
+        # True if the latest signal is well below what is normal for the device.
+        mac = mac.lower()
+        if mac not in self.rssi:
+            return False
+        return self.rssi[mac] < self.rssi_avg[mac] - self.rssi_margin
+
+    def best_adapter(self, mac):
+        # The adapter that hears the device best, or None if no adapter has heard it yet.
+        adapters = self.adapter_rssi.get(mac.lower())
+        if not adapters:
+            return None
+        return max(adapters, key=adapters.get)
+
+
+class DeviceHealth:
+    """Consecutive failures to read a device. Each failure doubles the time until the device
+    is tried again, up to probe_interval. After failure_threshold failures in a row the circuit
+    is open: the device is left out of the cycle and only probed, with a single connection
+    attempt, every probe_interval seconds until it answers again."""
+
+    def __init__(self, failure_threshold=5, probe_interval=900):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.failures = 0
+
+    @property
+    def open(self):
+        return self.failure_threshold > 0 and self.failures >= self.failure_threshold
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+
+    def delay(self, interval):
+        # Time to wait before trying the device again, given the normal interval between reads.
+        if self.open:
+            return self.probe_interval
+        return min(interval * 2 ** (self.failures - 1), max(interval, self.probe_interval))
+
+
 class AirthingsWaveDetect:
-    def __init__(self, scan_interval, mac=None):
+    def __init__(self, scan_interval, mac=None, max_concurrent=1, gatt_cache=None, keep_alive=False, read_every=None,
+                 adaptive=False, advertisements=None, transport=None, metrics=None, adapters=None, device_adapters=None,
+                 failure_threshold=5, probe_interval=900, connect_timeout=30, read_timeout=10, cycle_timeout=0, polling=None):
+        self.transport = transport if transport is not None else BleakTransport()
         self.airthing_devices = [] if mac is None else [mac]
+        self.devices = {}
+        # Model numbers taken from the advertisements seen by find_devices, used to pick what
+        # to read from a device before (or without) reading its device information.
+        self.model_hints = {}
         self.sensors = []
         self.sensordata = {}
         self.scan_interval = scan_interval
-        self.last_scan = -1
-        self._dev = None
-        self._command_data = None
-
-    def notification_handler(self, sender, data):
-        _LOGGER.debug("Notification handler: {0}: {1}".format(sender, data))
-        self._command_data = data
-        self._event.set()
-    
-    async def find_devices(self, scans=2, timeout=5):
-        # Search for devices, scan for BLE devices scans times for timeout seconds
-        # Get manufacturer data and try to match it to airthings ID.
-        
+        # Time (time.monotonic) at which each device is next due to be read, and the devices
+        # read by the last call to get_sensor_data. In adaptive mode the time is worked out
+        # from when the device takes its measurements rather than from scan_interval.
+        self.next_poll = {}
+        self.updated = set()
+        self.adaptive = adaptive
+        self.schedules = {}
+        # Optional AdvertisementMonitor used to hold off reading devices that have not been seen
+        # recently, or whose signal is weak, for up to max_defer seconds at a time.
+        self.advertisements = advertisements
+        # Optional PollingRules used to read devices whose values need watching more often.
+        self.polling = polling
+        self.defer_interval = 15
+        self.max_defer = 60
+        self._deferred = {}
+        # Maximum number of devices that are connected to at the same time. Each device
+        # gets its own client, so a value of 1 polls the devices one after the other.
+        self.max_concurrent = max(1, max_concurrent)
+        self._semaphores = {}
+        # Optional bluetooth adapters (e.g. {"hci0": 2, "hci1": None}) to spread the devices
+        # over, each with its own maximum number of connections (max_concurrent if None).
+        # Devices use the adapter set for them in device_adapters, else the adapter that
+        # hears them best, else the adapter with the fewest devices.
+        self.adapters = {name: max(1, limit or self.max_concurrent) for name, limit in (adapters or {}).items()}
+        self.device_adapters = {mac.lower(): adapter for mac, adapter in (device_adapters or {}).items()}
+        self._assigned = {}
+        # Optional GattCache. Devices in _rediscover had a failed read and have their
+        # sensors discovered again on the next connection.
+        self.gatt_cache = gatt_cache
+        self._rediscover = set()
+        # In keep alive mode connections stay open between cycles. Clients are dropped from
+        # _clients when the device disconnects and are reconnected when next needed.
+        self.keep_alive = keep_alive
+        self._clients = {}
+        self._read_plans = {}
+        # Slow changing or slow to read values can be read less often. read_every maps a
+        # decoder name (e.g. "battery") to the number of readings between reads of it.
+        self.read_every = dict(default_read_every)
+        self.read_every.update({name.lower(): max(1, int(n)) for name, n in (read_every or {}).items()})
+        self._read_counts = {}
+        # Optional metrics.BridgeMetrics recording how long connections and reads take.
+        self.metrics = metrics
+        # Devices that fail are tried again less and less often, and with fewer connection
+        # attempts, so that they do not hold up the devices that are working.
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.health = {}
+        self.retry_delay = 0.5
+        # Every bluetooth operation is given up after connect_timeout or read_timeout seconds,
+        # and a cycle after cycle_timeout seconds (0 for no limit). Devices not read by then
+        # are left in missed and are the first to be read next time.
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.cycle_timeout = cycle_timeout
+        self.missed = set()
+        # Optional callback, on_reading(mac, sensordata, reading), called as soon as each
+        # device has been read, with all of the values known for it and the values just read.
+        self.on_reading = None
+
+    async def discover_devices(self, timeout=10, expected=None):
+        # Scan for Airthings devices and yield (address, model_nr) for each one as soon as it
+        # is first heard. Stops after timeout seconds, or as soon as expected devices have been
+        # found, where expected is a number of devices or a collection of mac addresses.
         _LOGGER.debug("Scanning for airthings devices")
-        for _count in range(scans):
-            advertisements = await BleakScanner.discover(timeout)
-            for adv in advertisements:
-                if 820 in adv.metadata["manufacturer_data"]: # TODO: Not sure if this is the best way to identify Airthings devices
-                    if adv.address not in self.airthing_devices:
-                        self.airthing_devices.append(adv.address)
+        adapters = list(self.adapters) or [None]
+        if expected is not None and not isinstance(expected, int):
+            expected = set(mac.lower() for mac in expected)
+        found = asyncio.Queue()
+        seen = set()
+        best = {}
+
+        def detection_callback(device, advertisement_data, adapter):
+            hint = model_from_advertisement(advertisement_data.manufacturer_data)
+            if hint is None:
+                return
+            mac = device.address.lower()
+            # With several adapters they all scan at the same time, and each device is
+            # assigned to the adapter that heard it best.
+            rssi = advertisement_data.rssi
+            if adapter is not None and rssi is not None and (mac not in best or rssi > best[mac][0]):
+                best[mac] = (rssi, adapter)
+                self._assigned[mac] = adapter
+            if mac not in seen:
+                seen.add(mac)
+                if hint[1]:
+                    self.model_hints[mac] = hint[1]
+                found.put_nowait((device.address, hint[1] or None))
+
+        scanners = []
+        try:
+            for adapter in adapters:
+                callback = lambda device, advertisement_data, adapter=adapter: detection_callback(device, advertisement_data, adapter)
+                scanner = self.transport.scanner(detection_callback=callback, adapter=adapter)
+                await scanner.start()
+                scanners.append(scanner)
+
+            deadline = time.monotonic() + timeout
+            yielded = set()
+            while True:
+                if isinstance(expected, int) and len(yielded) >= expected:
+                    break
+                if isinstance(expected, set) and expected <= yielded:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    address, model_nr = await asyncio.wait_for(found.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                yielded.add(address.lower())
+                yield address, model_nr
+        finally:
+            for scanner in scanners:
+                try:
+                    await scanner.stop()
+                except Exception as e:
+                    _LOGGER.debug("Error stopping scan: {}".format(e))
+
+    async def find_devices(self, scans=2, timeout=5, expected=None):
+        # Search for devices for up to scans * timeout seconds, stopping early once the
+        # expected devices (a number of devices or a collection of mac addresses) are found.
+        # The model of each device is taken from its advertisement and kept in model_hints.
+        async for address, model_nr in self.discover_devices(scans * timeout, expected):
+            _LOGGER.debug("Found {}{}".format(address, " (model " + model_nr + ")" if model_nr else ""))
+            if address not in self.airthing_devices:
+                self.airthing_devices.append(address)
 
         _LOGGER.debug("Found {} airthings devices".format(len(self.airthing_devices)))
         return len(self.airthing_devices)
 
-    async def connect(self, mac, retries=10):  
-        _LOGGER.debug("Connecting to {}".format(mac))
-        await self.disconnect()
+    def adapter_for(self, mac):
+        # The adapter used to connect to a device, or None for the default adapter.
+        if not self.adapters:
+            return None
+        mac = mac.lower()
+        adapter = self.device_adapters.get(mac)
+        if adapter is None and self.advertisements is not None:
+            adapter = self.advertisements.best_adapter(mac)
+        if adapter is None:
+            adapter = self._assigned.get(mac)
+        if adapter not in self.adapters:
+            counts = {name: 0 for name in self.adapters}
+            for a in self._assigned.values():
+                if a in counts:
+                    counts[a] += 1
+            adapter = self._assigned[mac] = min(counts, key=counts.get)
+        return adapter
+
+    def _on_disconnected(self, client):
+        _LOGGER.debug("Device {} disconnected".format(client.address))
+        for mac, c in list(self._clients.items()):
+            if c is client:
+                del self._clients[mac]
+
+    async def _with_timeout(self, awaitable, timeout):
+        # Cancels the operation and raises asyncio.TimeoutError if it takes too long.
+        if not timeout:
+            return await awaitable
+        return await asyncio.wait_for(awaitable, timeout)
+
+    def _health(self, mac):
+        health = self.health.get(mac)
+        if health is None:
+            health = self.health[mac] = DeviceHealth(self.failure_threshold, self.probe_interval)
+        return health
+
+    async def connect(self, mac, retries=None, adapter=None):
+        # Returns a connected client for mac, or None if no connection could be made. Unless
+        # set, the number of attempts depends on how the device has been doing lately, and
+        # the adapter is the one picked by adapter_for.
+        client = self._clients.get(mac)
+        if client is not None and client.is_connected:
+            return client
+        if retries is None:
+            health = self._health(mac)
+            retries = 1 if health.open else 3 if health.failures > 0 else 10
+
+        if adapter is None:
+            adapter = self.adapter_for(mac)
+        _LOGGER.debug("Connecting to {}{}".format(mac, " using " + adapter if adapter is not None else ""))
+        client = self.transport.client(mac, disconnected_callback=self._on_disconnected, adapter=adapter)
+        start = time.monotonic()
         tries = 0
         while (tries < retries):
             tries += 1
             try:
-                self._dev = BleakClient(mac.lower())
-                ret = await self._dev.connect()
+                ret = await self._with_timeout(client.connect(), self.connect_timeout)
                 if ret:
                     _LOGGER.debug("Connected to {}".format(mac))
-                    break
+                    if self.keep_alive:
+                        self._clients[mac] = client
+                    if self.metrics is not None:
+                        self.metrics.connect_seconds.observe(time.monotonic() - start, device=mac)
+                        self.metrics.connect_attempts.observe(tries, device=mac)
+                    return client
             except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    # Make sure the connection attempt that timed out is not left behind.
+                    try:
+                        await self._with_timeout(client.disconnect(), self.read_timeout)
+                    except Exception:
+                        pass
                 if tries == retries:
                     _LOGGER.info("Not able to connect to {}".format(mac))
                     pass
                 else:
+                    # Give the bluetooth stack a moment before trying again.
                     _LOGGER.debug("Retrying {}".format(mac))
+                    await asyncio.sleep(min(self.retry_delay * 2 ** (tries - 1), 2))
+        if self.metrics is not None:
+            self.metrics.connect_failures.inc(device=mac)
+        return None
 
-    async def disconnect(self):
-        if self._dev is not None:
-            await self._dev.disconnect()
-            self._dev = None
+    async def disconnect(self, client, force=False):
+        # In keep alive mode the connection is left open unless force is set, for example
+        # after an error when the state of the connection is unknown.
+        if client is not None:
+            if self.keep_alive and not force and client.is_connected:
+                return
+            self._on_disconnected(client)
+            await self._with_timeout(client.disconnect(), self.read_timeout)
             _LOGGER.debug("Disconnected.")
 
-    async def get_info(self):
-        # Try to get some info from the discovered airthings devices
-        self.devices = {}
-        for mac in self.airthing_devices:
-            _LOGGER.debug("Getting device info for {}".format(mac))
+    async def close(self):
+        # Disconnect any connections kept open by keep alive mode.
+        for client in list(self._clients.values()):
             try:
-                await self.connect(mac)
-                if self._dev is not None and self._dev.is_connected:
-                    device = AirthingsDeviceInfo(serial_nr=mac)
-                    for characteristic in device_info_characteristics:
-                        try:
-                            data = await self._dev.read_gatt_char(characteristic.uuid)
-                            setattr(device, characteristic.name, data.decode(characteristic.format))
-                        except:
-                            _LOGGER.warning("Error getting {}".format(characteristic.name))
-                    self.devices[mac] = device
-                else:
-                   raise Exception("Could not connect to {}".format(mac))
+                await self.disconnect(client, force=True)
             except Exception as e:
-                _LOGGER.exception("Error getting device info for {}: {}".format(mac, e))
-            finally:
-                await self.disconnect()
-            
+                _LOGGER.warning("Error disconnecting from {}: {}".format(client.address, e))
+
+    async def _for_each_device(self, macs, func, deadline=None):
+        # Run func(mac, adapter) for every device, with at most max_concurrent devices in
+        # flight on each adapter. The adapter is picked once, so the device is connected to
+        # with the adapter whose limit it was counted against. Connections kept open by keep
+        # alive mode between cycles are not counted. Devices not done by deadline
+        # (time.monotonic) are cancelled and get {}, like a failed device, rather than holding
+        # up the results of the others. Devices not even started by then get None.
+        async def run(mac):
+            adapter = self.adapter_for(mac)
+            semaphore = self._semaphores.get(adapter)
+            if semaphore is None:
+                semaphore = self._semaphores[adapter] = asyncio.Semaphore(self.adapters.get(adapter, self.max_concurrent))
+            async with semaphore:
+                if deadline is None:
+                    return await func(mac, adapter)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    return await asyncio.wait_for(func(mac, adapter), remaining)
+                except asyncio.TimeoutError:
+                    _LOGGER.warning("Ran out of time while reading {}".format(mac))
+                    return {}
+
+        macs = list(macs)
+        results = await asyncio.gather(*[run(mac) for mac in macs])
+        return dict(zip(macs, results))
+
+    async def _read_device_info(self, mac, client):
+        device = AirthingsDeviceInfo(serial_nr=mac)
+        for characteristic in device_info_characteristics:
+            try:
+                data = await self._with_timeout(client.read_gatt_char(characteristic.uuid), self.read_timeout)
+                setattr(device, characteristic.name, data.decode(characteristic.format))
+            except:
+                _LOGGER.warning("Error getting {}".format(characteristic.name))
+        return device
+
+    async def _get_device_info(self, mac, adapter=None):
+        _LOGGER.debug("Getting device info for {}".format(mac))
+        client = None
+        try:
+            client = await self.connect(mac, adapter=adapter)
+            if client is not None and client.is_connected:
+                return await self._read_device_info(mac, client)
+            else:
+                raise Exception("Could not connect to {}".format(mac))
+        except Exception as e:
+            _LOGGER.exception("Error getting device info for {}: {}".format(mac, e))
+        finally:
+            await self.disconnect(client)
+
+    async def get_info(self):
+        # Try to get some info from the discovered airthings devices
+        results = await self._for_each_device(self.airthing_devices, self._get_device_info)
+        self.devices = {mac: device for mac, device in results.items() if device is not None}
         return self.devices
 
+    def _firmware_rev(self, mac):
+        device = self.devices.get(mac)
+        return device.firmware_rev if device is not None else None
+
+    async def _discover_sensors(self, mac, client):
+        sensor_characteristics =  []
+        svcs = await self._with_timeout(client.get_services(), self.read_timeout)
+        for service in svcs:
+            for characteristic in service.characteristics:
+                _LOGGER.debug(characteristic)
+                if characteristic.uuid in sensors_characteristics_uuid_str:
+                    sensor_characteristics.append(characteristic)
+
+        firmware_rev = self._firmware_rev(mac)
+        if self.gatt_cache is not None and firmware_rev is not None:
+            self.gatt_cache.put(mac, firmware_rev, sensor_characteristics)
+        self._rediscover.discard(mac)
+        return sensor_characteristics
+
+    def _cached_sensors(self, mac):
+        firmware_rev = self._firmware_rev(mac)
+        if self.gatt_cache is not None and firmware_rev is not None:
+            sensor_characteristics = self.gatt_cache.get(mac, firmware_rev)
+            if sensor_characteristics is not None:
+                _LOGGER.debug("Using cached sensors for {}".format(mac))
+                return sensor_characteristics
+        return None
+
+    async def _get_sensors(self, mac, adapter=None):
+        sensor_characteristics = self._cached_sensors(mac)
+        if sensor_characteristics is not None:
+            return sensor_characteristics
+
+        _LOGGER.debug("Getting sensors for {}".format(mac))
+        client = None
+        try:
+            client = await self.connect(mac, adapter=adapter)
+            if client is not None and client.is_connected:
+                return await self._discover_sensors(mac, client)
+            else:
+                raise Exception("Could not connect to {}".format(mac))
+        except Exception as e:
+            _LOGGER.exception("Error getting sensors for {}: {}".format(mac, e))
+        finally:
+            await self.disconnect(client)
+
     async def get_sensors(self):
-        self.sensors = {}
-        for mac in self.airthing_devices:
-            _LOGGER.debug("Getting sensors for {}".format(mac))
-            try:
-                await self.connect(mac)
-                if self._dev is not None and self._dev.is_connected:
-                    sensor_characteristics =  []
-                    svcs = await self._dev.get_services()
-                    for service in svcs:
-                        for characteristic in service.characteristics:
-                            _LOGGER.debug(characteristic)
-                            if characteristic.uuid in sensors_characteristics_uuid_str:
-                                sensor_characteristics.append(characteristic)
-                    self.sensors[mac] = sensor_characteristics
-                else:
-                    raise Exception("Could not connect to {}".format(mac))
-            except Exception as e:
-                _LOGGER.exception("Error getting sensors for {}: {}".format(mac, e))
-            finally:
-                await self.disconnect()
-        
+        results = await self._for_each_device(self.airthing_devices, self._get_sensors)
+        self.sensors = {mac: sensors for mac, sensors in results.items() if sensors is not None}
         return self.sensors
 
+    async def _read_char(self, mac, client, characteristic):
+        start = time.monotonic()
+        data = await self._with_timeout(client.read_gatt_char(characteristic.handle), self.read_timeout)
+        if self.metrics is not None:
+            self.metrics.read_seconds.observe(time.monotonic() - start, device=mac, characteristic=str(characteristic.uuid))
+        return data
+
+    async def _read_command(self, mac, client, characteristic, decoder):
+        # The command characteristic answers through a notification, so each call gets its
+        # own event and buffer rather than sharing state between devices.
+        event = asyncio.Event()
+        command_data = []
+
+        def notification_handler(sender, data):
+            _LOGGER.debug("Notification handler: {0}: {1}".format(sender, data))
+            command_data.append(data)
+            event.set()
+
+        # Set up the notification handlers
+        await self._with_timeout(client.start_notify(characteristic.handle, notification_handler), self.read_timeout)
+        try:
+            # send command to this 'indicate' characteristic
+            await self._with_timeout(client.write_gatt_char(characteristic.handle, decoder.cmd), self.read_timeout)
+            # Wait for up to one second to see if a callblack comes in.
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(event.wait(), 1)
+            except asyncio.TimeoutError:
+                _LOGGER.warning("Timeout getting command data.")
+            if self.metrics is not None:
+                self.metrics.notification_seconds.observe(time.monotonic() - start, device=mac)
+        finally:
+            # Stop notification handler
+            await self._with_timeout(client.stop_notify(characteristic.handle), self.read_timeout)
+
+        if command_data:
+            return command_data[-1]
+        return None
+
+    def _read_plan(self, mac):
+        # Returns the characteristics to read and the command characteristics to query for
+        # a device, worked out again whenever its sensors change.
+        characteristics = self.sensors[mac]
+        plan = self._read_plans.get(mac)
+        if plan is None or plan[0] is not characteristics:
+            device = self.devices.get(mac)
+            model_nr = device.model_nr if device is not None and device.model_nr else self.model_hints.get(mac.lower())
+            selected = build_read_plan(characteristics, model_nr)
+            # Decoders are looked up by handle from here on.
+            handles = decoders.bind(mac, selected)
+            reads = [c for c in selected if c.handle in handles and not decoders.is_command(handles[c.handle])]
+            commands = [c for c in selected if c.handle in handles and decoders.is_command(handles[c.handle])]
+            _LOGGER.debug("{}: Reading {} of {} characteristics".format(mac, len(reads) + len(commands), len(characteristics)))
+            plan = (characteristics, reads, commands)
+            self._read_plans[mac] = plan
+        return plan[1], plan[2]
+
+    def _is_due(self, decoder, count):
+        return count % self.read_every.get(decoder.name.lower(), 1) == 0
+
+    async def _read_sensors(self, mac, client):
+        sensordata = None
+        try:
+            if mac in self._rediscover:
+                _LOGGER.info("Discovering sensors again for {}".format(mac))
+                self.sensors[mac] = await self._discover_sensors(mac, client)
+
+            reads, commands = self._read_plan(mac)
+            count = self._read_counts.get(mac, 0)
+            if self.read_every:
+                reads = [c for c in reads if self._is_due(decoders.for_handle(mac, c.handle), count)]
+                commands = [c for c in commands if self._is_due(decoders.for_handle(mac, c.handle), count)]
+
+            # Characteristics are read by handle, which also works for handles loaded
+            # from the GATT cache without discovering the services. The reads are
+            # independent of each other so they are all sent at once.
+            results = await asyncio.gather(*[self._read_char(mac, client, c) for c in reads])
+            sensordata = decoders.decode_batch(zip([c.handle for c in reads], results), mac)
+            _LOGGER.debug("{} Got sensordata {}".format(mac, sensordata))
+
+            for characteristic in commands:
+                _LOGGER.debug("command characteristic: {}".format(characteristic.uuid))
+                decoder = decoders.for_handle(mac, characteristic.handle)
+                decoder.decode_into(sensordata, await self._read_command(mac, client, characteristic, decoder))
+            self._read_counts[mac] = count + 1
+        except Exception:
+            # The cached handles may be stale, so forget them and discover again next time.
+            self._rediscover.add(mac)
+            if self.gatt_cache is not None:
+                self.gatt_cache.invalidate(mac)
+            raise
+
+        return sensordata
+
+    async def _get_sensor_data(self, mac, adapter=None):
+        _LOGGER.debug("Getting sensor data for {}".format(mac))
+        client = None
+        failed = False
+        start = time.monotonic()
+        try:
+            client = await self.connect(mac, adapter=adapter)
+            if client is not None and client.is_connected:
+                sensor_data = await self._read_sensors(mac, client)
+                self._store_sensor_data({mac: sensor_data})
+                if self.on_reading is not None and sensor_data:
+                    self.on_reading(mac, self.sensordata[mac], sensor_data)
+                if self._health(mac).failures > 0:
+                    _LOGGER.info("{} is answering again".format(mac))
+                self._health(mac).success()
+                if self.metrics is not None:
+                    self.metrics.device_cycle_seconds.observe(time.monotonic() - start, device=mac)
+                    self.metrics.success(mac)
+                    self.metrics.circuit_open.set(0, device=mac)
+                return sensor_data
+            else:
+                raise Exception("Could not connect to {}".format(mac))
+        except Exception as e:
+            _LOGGER.exception("Error getting sensor data for '{}': {}".format(mac, e or type(e).__name__))
+            failed = True
+            health = self._health(mac)
+            health.failure()
+            if health.failures == health.failure_threshold:
+                _LOGGER.warning("{} failed {} times in a row, only trying it every {} seconds".format(mac, health.failures, health.probe_interval))
+            if self.metrics is not None:
+                self.metrics.device_failures.inc(device=mac)
+                self.metrics.circuit_open.set(1 if health.open else 0, device=mac)
+        except asyncio.CancelledError:
+            # Out of time for this cycle. The state of the connection is unknown, and a device
+            # that is this slow is tried again later, like one that failed.
+            failed = True
+            self._health(mac).failure()
+            raise
+        finally:
+            await self.disconnect(client, force=failed)
+
+        return {}
+
+    async def _onboard(self, mac, adapter=None):
+        # Get the device info, the sensors and a first reading over a single connection.
+        _LOGGER.debug("Setting up {}".format(mac))
+        client = None
+        failed = False
+        try:
+            client = await self.connect(mac, adapter=adapter)
+            if client is not None and client.is_connected:
+                self.devices[mac] = await self._read_device_info(mac, client)
+                sensor_characteristics = self._cached_sensors(mac)
+                if sensor_characteristics is None:
+                    _LOGGER.debug("Getting sensors for {}".format(mac))
+                    sensor_characteristics = await self._discover_sensors(mac, client)
+                self.sensors[mac] = sensor_characteristics
+                sensor_data = await self._read_sensors(mac, client)
+                if self.metrics is not None:
+                    self.metrics.success(mac)
+                return sensor_data
+            else:
+                raise Exception("Could not connect to {}".format(mac))
+        except Exception as e:
+            _LOGGER.exception("Error setting up {}: {}".format(mac, e))
+            failed = True
+        except asyncio.CancelledError:
+            failed = True
+            raise
+        finally:
+            await self.disconnect(client, force=failed)
+
+        return {}
+
+    async def onboard(self):
+        # Combines get_info, get_sensors and the first get_sensor_data so each device is only
+        # connected to once at startup.
+        self.devices = {}
+        self.sensors = {}
+        self.updated = set()
+        start = time.monotonic()
+        results = await self._for_each_device(self.airthing_devices, self._onboard)
+        self._store_sensor_data(results)
+        for mac, sensor_data in results.items():
+            self._schedule(mac, start, sensor_data)
+        return self.devices
+
+    def _schedule(self, mac, start, sensor_data):
+        # Work out when to read a device next, after a reading that started at start.
+        health = self.health.get(mac)
+        if health is not None and health.failures > 0:
+            self.next_poll[mac] = start + health.delay(self.scan_interval)
+        elif self.adaptive and sensor_data:
+            schedule = self.schedules.get(mac)
+            if schedule is None:
+                schedule = self.schedules[mac] = MeasurementSchedule()
+            now = time.monotonic()
+            values = {k: v for k, v in sensor_data.items() if k != "measurement_periods"}
+            schedule.update(now, sensor_data.get("measurement_periods"), values)
+            self.next_poll[mac] = schedule.next_poll(now, self.scan_interval)
+        else:
+            self.next_poll[mac] = start + self.scan_interval
+
+        if self.polling is not None and sensor_data and (health is None or health.failures == 0):
+            # The rules are checked against all of the values known for the device.
+            if self.polling.update(mac, self.sensordata.get(mac, sensor_data)):
+                self.next_poll[mac] = min(self.next_poll[mac], start + self.polling.fast_interval)
+            elif self.polling.slow_interval and not self.adaptive:
+                self.next_poll[mac] = start + self.polling.slow_interval
+
+    def next_poll_time(self):
+        # Time (time.monotonic) at which the next device is due to be read.
+        return min(self.next_poll.values(), default=time.monotonic() + self.scan_interval)
+
+    def _defer(self, mac, now):
+        # Returns True if reading the device should be put off for now.
+        if self.advertisements is None:
+            return False
+        client = self._clients.get(mac)
+        if client is not None and client.is_connected:
+            # Devices stop advertising while connected, so an open connection is all the
+            # sign of being in range that is needed.
+            self._deferred.pop(mac, None)
+            return False
+        if not self.advertisements.seen_recently(mac, now):
+            _LOGGER.debug("{} has not been seen recently, skipping".format(mac))
+            self._deferred.pop(mac, None)
+            self.next_poll[mac] = now + self.defer_interval
+            return True
+        if self.advertisements.weak_signal(mac):
+            since = self._deferred.setdefault(mac, now)
+            if now - since < self.max_defer:
+                _LOGGER.debug("{} has a weak signal, waiting for a better one".format(mac))
+                self.next_poll[mac] = now + self.defer_interval
+                return True
+        self._deferred.pop(mac, None)
+        return False
+
     async def get_sensor_data(self):
-        if time.monotonic() - self.last_scan > self.scan_interval or self.last_scan == -1:
-            self.last_scan = time.monotonic()
-            for mac, characteristics in self.sensors.items():
-                _LOGGER.debug("Getting sensor data for {}".format(mac))
-                try:
-                    await self.connect(mac)
-                    if self._dev is not None and self._dev.is_connected:                    
-                        for characteristic in characteristics:
-                            sensor_data = None
-                            if str(characteristic.uuid) in sensor_decoders:
-                                data = await self._dev.read_gatt_char(characteristic.uuid)
-                                sensor_data = sensor_decoders[str(characteristic.uuid)].decode_data(data)
-                                _LOGGER.debug("{} Got sensordata {}".format(mac, sensor_data))
-                            
-                            if str(characteristic.uuid) in command_decoders:
-                                _LOGGER.debug("command characteristic: {}".format(characteristic.uuid))
-                                # Create an Event object.
-                                self._event = asyncio.Event()
-                                # Set up the notification handlers
-                                await self._dev.start_notify(characteristic.uuid, self.notification_handler)
-                                # send command to this 'indicate' characteristic
-                                await self._dev.write_gatt_char(characteristic.uuid, command_decoders[str(characteristic.uuid)].cmd)
-                                # Wait for up to one second to see if a callblack comes in.
-                                try:
-                                    await asyncio.wait_for(self._event.wait(), 1)
-                                except asyncio.TimeoutError:
-                                    _LOGGER.warn("Timeout getting command data.")
-                                if self._command_data is not None:
-                                    sensor_data = command_decoders[str(characteristic.uuid)].decode_data(self._command_data)
-                                    self._command_data = None
-                                # Stop notification handler
-                                await self._dev.stop_notify(characteristic.uuid)
-
-                            if sensor_data is not None:
-                                if self.sensordata.get(mac) is None:
-                                    self.sensordata[mac] = sensor_data
-                                else:
-                                    self.sensordata[mac].update(sensor_data)
-                    else:
-                        raise Exception("Could not connect to {}".format(mac))
-                except Exception as e:
-                    _LOGGER.exception("Error getting sensor data for '{}': {}".format(mac, e))
-                
-                finally:
-                    await self.disconnect()
+        start = time.monotonic()
+        due = [mac for mac in self.sensors if self.next_poll.get(mac, start) <= start and not self._defer(mac, start)]
+        # The devices waiting longest go first, so that with a cycle_timeout the same devices
+        # do not miss out every time.
+        due.sort(key=lambda mac: self.next_poll.get(mac, start))
+        self.updated = set()
+        self.missed = set()
+        if due:
+            deadline = start + self.cycle_timeout if self.cycle_timeout else None
+            results = await self._for_each_device(due, self._get_sensor_data, deadline)
+            self.missed = set(mac for mac, sensor_data in results.items() if sensor_data is None)
+            if self.missed:
+                _LOGGER.warning("Ran out of time before reading {} of {} device(s): {}".format(len(self.missed), len(due), ", ".join(sorted(self.missed))))
+                if self.metrics is not None:
+                    self.metrics.deadline_misses.inc(len(self.missed))
+            # The readings were stored as each device was read.
+            results = {mac: sensor_data for mac, sensor_data in results.items() if sensor_data is not None}
+            for mac, sensor_data in results.items():
+                self._schedule(mac, start, sensor_data)
 
         return self.sensordata
 
+    def _store_sensor_data(self, results):
+        for mac, sensor_data in results.items():
+            if not sensor_data:
+                continue
+            self.updated.add(mac)
+            if self.sensordata.get(mac) is None:
+                self.sensordata[mac] = sensor_data
+            else:
+                self.sensordata[mac].update(sensor_data)
+
 async def main():
     logging.basicConfig()
     _LOGGER.setLevel(logging.DEBUG)
     ad = AirthingsWaveDetect(0)
     num_dev_found = await ad.find_devices()
     if num_dev_found > 0:
-        devices = await ad.get_info()
+        devices = await ad.onboard()
         for mac, dev in devices.items():
             _LOGGER.info("Device: {}: {}".format(mac, dev))
 
-        devices_sensors = await ad.get_sensors()
-        for mac, sensors in devices_sensors.items():
+        for mac, sensors in ad.sensors.items():
             for sensor in sensors:
                 _LOGGER.info("Sensor: {}: {}".format(mac, sensor))
 
@@ -371,6 +1342,8 @@ async def main():
             for name, val in data.items():
                 _LOGGER.info("Sensor data: {}: {}: {}".format(mac, name, val))
 
+    await ad.close()
+
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,161 @@
+# Copyright (c) 2022 Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import logging
+import os
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ReadingBuffer:
+    """Readings that could not be sent to the mqtt broker, kept on disk until it is back.
+
+    Readings are appended, one compact json line each, to numbered segment files in a
+    directory. They are read back oldest first in batches, and a segment is deleted once all
+    of its readings have been sent. The position reached is saved so nothing is sent twice
+    after a restart, except for a batch that was being sent at the time. Whole segments are
+    dropped, oldest first, once the buffer is larger than max_bytes or their readings are
+    older than max_age seconds.
+    """
+
+    def __init__(self, path, max_bytes=10000000, max_age=604800, segment_bytes=262144):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = segment_bytes
+        os.makedirs(self.path, exist_ok=True)
+        self._segments = sorted(int(name[:-6]) for name in os.listdir(self.path) if name.endswith(".jsonl") and name[:-6].isdigit())
+        if self._segments:
+            self._repair(self._segments[-1])
+        self._sizes = {n: os.path.getsize(self._segment_path(n)) for n in self._segments}
+        self._position = (self._segments[0], 0) if self._segments else None
+        try:
+            with open(os.path.join(self.path, "position.json")) as f:
+                segment, offset = json.load(f)
+            if segment in self._sizes:
+                self._position = (segment, offset)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            _LOGGER.warning("Ignoring unreadable buffer position in {}: {}".format(self.path, e))
+        if self._segments:
+            _LOGGER.info("{} bytes of readings waiting to be sent in {}".format(sum(self._sizes.values()), self.path))
+
+    def _segment_path(self, n):
+        return os.path.join(self.path, "{:010d}.jsonl".format(n))
+
+    def _repair(self, segment):
+        # A power loss while appending can leave part of a line at the end of the segment
+        # being written. Cut it off so the next reading starts on a line of its own.
+        path = self._segment_path(segment)
+        with open(path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                _LOGGER.warning("Dropping {} bytes of a partly written reading in {}".format(len(data) - end, path))
+                f.truncate(end)
+
+    def __bool__(self):
+        return self._position is not None and (self._position[0] != self._segments[-1] or self._position[1] < self._sizes[self._segments[-1]])
+
+    def append(self, timestamp, mac, values):
+        # Add a reading taken at timestamp (seconds since the epoch).
+        line = (json.dumps({"t": round(timestamp, 3), "mac": mac, "v": values}, separators=(",", ":")) + "\n").encode()
+        if not self._segments or self._sizes[self._segments[-1]] + len(line) > self.segment_bytes:
+            self._segments.append(self._segments[-1] + 1 if self._segments else 1)
+            self._sizes[self._segments[-1]] = 0
+            if self._position is None:
+                self._position = (self._segments[-1], 0)
+        segment = self._segments[-1]
+        with open(self._segment_path(segment), "ab") as f:
+            f.write(line)
+        self._sizes[segment] += len(line)
+        self.evict()
+
+    def evict(self, now=None):
+        # Drop the oldest segments while the buffer is too big or their readings too old.
+        now = time.time() if now is None else now
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            too_old = self.max_age > 0 and now - os.path.getmtime(self._segment_path(oldest)) > self.max_age
+            if not too_old and sum(self._sizes.values()) <= self.max_bytes:
+                break
+            _LOGGER.warning("Dropping {} bytes of buffered readings that could not be sent in time.".format(self._sizes[oldest]))
+            self._remove(oldest)
+
+    def _remove(self, segment):
+        self._segments.remove(segment)
+        del self._sizes[segment]
+        try:
+            os.remove(self._segment_path(segment))
+        except FileNotFoundError:
+            pass
+        if self._position is not None and self._position[0] == segment:
+            self._position = (self._segments[0], 0) if self._segments else None
+            self._save_position()
+
+    def read_batch(self, max_readings=100):
+        # Returns up to max_readings of the oldest readings and the position to pass to
+        # commit() once they have been sent.
+        if not self:
+            return [], self._position
+        segment, offset = self._position
+        if offset >= self._sizes[segment]:
+            # Reached the end of a segment that is no longer being written.
+            segment, offset = self._segments[self._segments.index(segment) + 1], 0
+        readings = []
+        start = offset
+        with open(self._segment_path(segment), "rb") as f:
+            f.seek(offset)
+            while len(readings) < max_readings:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    readings.append(json.loads(line))
+                except ValueError:
+                    _LOGGER.warning("Skipping unreadable buffered reading in {}".format(self._segment_path(segment)))
+        if offset == start and offset < self._sizes[segment]:
+            # Nothing but part of a line is left, which can never be completed, so skip it.
+            _LOGGER.warning("Skipping {} bytes of a partly written reading in {}".format(self._sizes[segment] - offset, self._segment_path(segment)))
+            offset = self._sizes[segment]
+        return readings, (segment, offset)
+
+    def commit(self, position):
+        # Forget the readings up to position, deleting any segments that have been sent.
+        segment, offset = position
+        while self._segments and self._segments[0] < segment:
+            self._remove(self._segments[0])
+        self._position = position
+        if segment != self._segments[-1] and offset >= self._sizes[segment]:
+            self._remove(segment)
+        self._save_position()
+
+    def _save_position(self):
+        try:
+            tmp = os.path.join(self.path, "position.json.tmp")
+            with open(tmp, "w") as f:
+                json.dump(self._position, f)
+            os.replace(tmp, os.path.join(self.path, "position.json"))
+        except Exception as e:
+            _LOGGER.warning("Could not save buffer position in {}: {}".format(self.path, e))
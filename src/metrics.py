@@ -0,0 +1,195 @@
+# Copyright (c) 2022 Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Metrics about the bluetooth and mqtt communication, served over http in the Prometheus
+# text format so they can be scraped by Prometheus or anything else that reads it. This
+# deliberately has no dependencies beyond the standard library.
+
+import asyncio
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ATTEMPT_BUCKETS = (1, 2, 3, 5, 10)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        # Yields (suffix, label values, extra label, value) for each sample.
+        for key, value in self._values.items():
+            yield "", key, None, value
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, _format_labels(self.labels, key, extra), value))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield "_total", key, None, value
+
+
+class Gauge(Metric):
+    """A value that can go up and down. If function is set it is called when the metrics are
+    collected and returns a dict of label values tuples to values."""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def samples(self):
+        values = self.function() if self.function is not None else self._values
+        for key, value in values.items():
+            yield "", key, None, value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # Bucket counts, then the sum and count of all values.
+            entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[i] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def samples(self):
+        for key, entry in self._values.items():
+            for bound, count in zip(self.buckets, entry):
+                yield "_bucket", key, ("le", bound), count
+            yield "_bucket", key, ("le", "+Inf"), entry[-1]
+            yield "_sum", key, None, entry[-2]
+            yield "_count", key, None, entry[-1]
+
+
+class BridgeMetrics:
+    """The metrics collected by AirthingsWaveDetect and the main script."""
+
+    def __init__(self):
+        self.connect_seconds = Histogram("airthings_connect_seconds", "Time taken to connect to a device, including retries.", ["device"])
+        self.connect_attempts = Histogram("airthings_connect_attempts", "Number of attempts needed to connect to a device.", ["device"], ATTEMPT_BUCKETS)
+        self.connect_failures = Counter("airthings_connect_failures", "Connections to a device that failed after all retries.", ["device"])
+        self.read_seconds = Histogram("airthings_read_seconds", "Time taken to read a characteristic.", ["device", "characteristic"])
+        self.notification_seconds = Histogram("airthings_notification_wait_seconds", "Time waited for the answer to a command.", ["device"])
+        self.device_cycle_seconds = Histogram("airthings_device_cycle_seconds", "Time taken to connect to and read all sensor values from a device.", ["device"])
+        self.device_failures = Counter("airthings_device_failures", "Attempts to read the sensor values of a device that failed.", ["device"])
+        self.deadline_misses = Counter("airthings_deadline_misses", "Devices that could not be read before the end of the cycle_timeout.")
+        self.circuit_open = Gauge("airthings_device_circuit_open", "1 if a device failed too often and is only tried now and then.", ["device"])
+        self.last_success_age = Gauge("airthings_last_success_age_seconds", "Seconds since the sensor values of a device were last read.", ["device"])
+        self.mqtt_publish_seconds = Histogram("airthings_mqtt_publish_seconds", "Time taken for the mqtt broker to acknowledge a batch of messages.")
+        self.mqtt_messages = Counter("airthings_mqtt_messages", "Messages sent to the mqtt broker.")
+        self.mqtt_publish_failures = Counter("airthings_mqtt_publish_failures", "Batches of messages that the mqtt broker did not acknowledge.")
+        self.last_success = {}
+
+        self.last_success_age.function = self._last_success_ages
+
+    def success(self, mac):
+        self.last_success[mac] = time.monotonic()
+
+    def _last_success_ages(self):
+        now = time.monotonic()
+        return {(mac,): round(now - t, 3) for mac, t in self.last_success.items()}
+
+    def render(self):
+        metrics = [m for m in vars(self).values() if isinstance(m, Metric)]
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+class MetricsServer:
+    """Minimal http server answering GET /metrics with the current metrics."""
+
+    def __init__(self, metrics, port, host="0.0.0.0"):
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        _LOGGER.info("Serving metrics on http://{}:{}/metrics".format(self.host, self.port))
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            # Skip the request headers.
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write("HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+                         .format(status, len(body)).encode() + body)
+            await writer.drain()
+        except Exception as e:
+            _LOGGER.debug("Error answering metrics request: {}".format(e))
+        finally:
+            writer.close()
@@ -0,0 +1,222 @@
+# Copyright (c) 2022 Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from paho.mqtt import MQTTException
+
+_LOGGER = logging.getLogger(__name__)
+
+# Most acknowledgements remembered for messages that publish() has not registered yet, or
+# that were given up on. Anything older than this is long out of date.
+MAX_REMEMBERED_MIDS = 1000
+
+
+class MQTTSession:
+    """Long-lived connection to the mqtt broker.
+
+    The paho network loop runs in its own thread and takes care of reconnecting, so
+    publishing never blocks the asyncio loop. Messages are sent with QoS 1, which lets
+    paho queue them while the broker is unavailable and limits how many are in flight.
+    Messages that are not acknowledged in time stay in paho's queue, and their late
+    acknowledgements are ignored.
+    """
+
+    def __init__(self, host, port=1883, client_id="airthings-mqtt", auth=None, max_inflight=20, keepalive=60, client=None,
+                 max_queued=1000):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self._loop = None
+        self._lock = threading.Lock()
+        self._pending = {}      # mid -> future waiting for the broker to acknowledge it
+        self._completed = {}    # mids acknowledged before their future was registered
+        self._timed_out = {}    # mids given up on that paho may still acknowledge
+        self._subscriptions = {}
+
+        if client is not None:
+            # An existing client, or a stand-in for one when benchmarking.
+            self._client = client
+        else:
+            try:
+                # paho-mqtt 2.x requires the callback API version to be chosen explicitly.
+                self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id)
+            except AttributeError:
+                self._client = mqtt.Client(client_id=client_id)
+        if auth is not None:
+            self._client.username_pw_set(auth["username"], auth["password"])
+        self._client.max_inflight_messages_set(max_inflight)
+        self._client.max_queued_messages_set(max_queued)
+        self._client.reconnect_delay_set(min_delay=1, max_delay=120)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+        self._client.on_message = self._on_message
+
+    @property
+    def is_connected(self):
+        return self._client.is_connected()
+
+    async def connect(self, timeout=10):
+        # Start the network loop and wait a little while for the first connection. If the
+        # broker is not reachable yet, paho keeps trying in the background.
+        self._loop = asyncio.get_running_loop()
+        _LOGGER.info("Connecting to mqtt broker {}:{}...".format(self.host, self.port))
+        self._client.connect_async(self.host, self.port, self.keepalive)
+        self._client.loop_start()
+        deadline = self._loop.time() + timeout
+        while not self.is_connected and self._loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        return self.is_connected
+
+    async def close(self):
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            _LOGGER.info("Connected to mqtt broker.")
+            for topic in self._subscriptions:
+                client.subscribe(topic)
+        else:
+            _LOGGER.error("Connection to mqtt broker refused: {}".format(mqtt.connack_string(rc)))
+
+    def _on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            _LOGGER.warning("Lost connection to mqtt broker, reconnecting...")
+
+    def _on_publish(self, client, userdata, mid):
+        # Called from the paho thread, possibly before publish() has registered the future.
+        with self._lock:
+            future = self._pending.pop(mid, None)
+            if future is None:
+                if mid in self._timed_out:
+                    # A late acknowledgement of a message given up on.
+                    del self._timed_out[mid]
+                else:
+                    self._remember(self._completed, mid)
+                return
+        self._loop.call_soon_threadsafe(self._resolve, future)
+
+    @staticmethod
+    def _remember(mids, mid):
+        # Add mid to mids (a dict used as an ordered set), forgetting the oldest ones.
+        mids.pop(mid, None)
+        mids[mid] = None
+        while len(mids) > MAX_REMEMBERED_MIDS:
+            del mids[next(iter(mids))]
+
+    def _on_message(self, client, userdata, message):
+        callback = self._subscriptions.get(message.topic)
+        if callback is not None:
+            self._loop.call_soon_threadsafe(callback, message.payload)
+
+    def subscribe(self, topic, callback):
+        # Call callback(payload) on the asyncio loop for messages on topic. Subscriptions are
+        # renewed whenever the connection is made again.
+        self._subscriptions[topic] = callback
+        if self.is_connected:
+            self._client.subscribe(topic)
+
+    @staticmethod
+    def _resolve(future):
+        if not future.done():
+            future.set_result(True)
+
+    def publish(self, topic, payload=None, retain=False, qos=1):
+        # Hand a message to paho and return a future that completes once the broker has it.
+        future = self._loop.create_future()
+        info = self._client.publish(topic, payload, qos, retain)
+        if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            future.set_exception(MQTTException("Error publishing to {}: {}".format(topic, mqtt.error_string(info.rc))))
+            return future
+        if info.rc == mqtt.MQTT_ERR_NO_CONN and qos == 0:
+            future.set_exception(MQTTException("Not connected to mqtt broker."))
+            return future
+        with self._lock:
+            # paho reuses mids once they wrap around, so an earlier message given up on with
+            # the same mid no longer matters.
+            self._timed_out.pop(info.mid, None)
+            if info.mid in self._completed:
+                del self._completed[info.mid]
+                future.set_result(True)
+            else:
+                self._pending[info.mid] = future
+        return future
+
+    async def publish_multiple(self, msgs, timeout=30):
+        # Publish a list of messages in the same format as paho.mqtt.publish.multiple and wait
+        # for them to be acknowledged. Returns False if the broker did not confirm them in time,
+        # in which case paho still sends the messages not confirmed when it can.
+        futures = [self.publish(m["topic"], m.get("payload"), m.get("retain", False), m.get("qos", 1)) for m in msgs]
+        if not futures:
+            return True
+        done, pending = await asyncio.wait(futures, timeout=timeout)
+        if pending:
+            with self._lock:
+                # Ignore their acknowledgements if they do arrive.
+                for mid in [mid for mid, f in self._pending.items() if f in pending]:
+                    del self._pending[mid]
+                    self._remember(self._timed_out, mid)
+            for future in pending:
+                future.cancel()
+        for future in done:
+            # Raises the first publish error, if any.
+            future.result()
+        return not pending
+
+
+class PublishFilter:
+    """Keeps the last value sent on each topic, and when, so that only values that have
+    changed, or moved by more than the deadband set for the sensor, are sent again. A value
+    is sent regardless once heartbeat seconds have passed since it was last sent on its
+    topic, however often or rarely its device is read."""
+
+    def __init__(self, deadbands=None, heartbeat=3600):
+        self.deadbands = deadbands or {}
+        self.heartbeat = heartbeat
+        self._last = {}     # topic -> (value, time.monotonic() when sent)
+
+    def reset(self, prefix=None):
+        # Send all values again, or those on topics starting with prefix, for example after
+        # they could not be sent.
+        if prefix is None:
+            self._last.clear()
+        else:
+            for topic in [t for t in self._last if t.startswith(prefix)]:
+                del self._last[topic]
+
+    def changed(self, topic, name, value, now=None):
+        # Returns True if value should be sent on topic, and remembers it if so.
+        now = time.monotonic() if now is None else now
+        last = self._last.get(topic)
+        if last is not None and (self.heartbeat <= 0 or now - last[1] < self.heartbeat):
+            last = last[0]
+            if isinstance(value, (int, float)) and isinstance(last, (int, float)):
+                if abs(value - last) < self.deadbands.get(name, 0) or value == last:
+                    return False
+            elif value == last:
+                return False
+        self._last[topic] = (value, now)
+        return True
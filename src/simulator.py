@@ -0,0 +1,255 @@
+# Copyright (c) 2022 Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# A simulated fleet of Airthings devices that can be used in place of bleak, so the script
+# can be tried out and load tested without any bluetooth hardware.
+
+import asyncio
+import logging
+import random
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+from airthings import (CHAR_UUID_MANUFACTURER_NAME, CHAR_UUID_SERIAL_NUMBER_STRING, CHAR_UUID_MODEL_NUMBER_STRING,
+                       CHAR_UUID_DEVICE_NAME, CHAR_UUID_FIRMWARE_REV, CHAR_UUID_HARDWARE_REV, CHAR_UUID_DATETIME,
+                       CHAR_UUID_WAVE_PLUS_DATA, CHAR_UUID_WAVE_2_DATA, CHAR_UUID_WAVEMINI_DATA, COMMAND_UUID)
+
+_LOGGER = logging.getLogger(__name__)
+
+SimulatedCharacteristic = namedtuple('SimulatedCharacteristic', ['uuid', 'handle', 'properties'])
+SimulatedService = namedtuple('SimulatedService', ['uuid', 'characteristics'])
+SimulatedBLEDevice = namedtuple('SimulatedBLEDevice', ['address', 'name', 'rssi', 'metadata'])
+SimulatedAdvertisementData = namedtuple('SimulatedAdvertisementData', ['manufacturer_data', 'rssi'])
+
+# Model number, device name and the sensor characteristics of each simulated model.
+MODELS = {"wave_plus": ("2930", "Airthings Wave+", [CHAR_UUID_WAVE_PLUS_DATA, COMMAND_UUID, CHAR_UUID_DATETIME]),
+          "wave2": ("2950", "Airthings Wave", [CHAR_UUID_WAVE_2_DATA, CHAR_UUID_DATETIME]),
+          "wave_mini": ("2920", "Airthings Wave Mini", [CHAR_UUID_WAVEMINI_DATA, CHAR_UUID_DATETIME])}
+
+
+class SimulatedDevice:
+    def __init__(self, mac, model, serial_nr, rng, measurement_period=300):
+        self.mac = mac
+        self.model = model
+        self.model_nr, self.device_name, sensor_uuids = MODELS[model]
+        self.serial_nr = serial_nr
+        self.measurement_period = measurement_period
+        self.rssi = rng.randint(-90, -50)
+        self._rng = rng
+        self._phase = rng.uniform(0, measurement_period)
+        self._counter = None
+
+        self.info = {str(CHAR_UUID_MANUFACTURER_NAME): b"Airthings AS",
+                     str(CHAR_UUID_SERIAL_NUMBER_STRING): str(serial_nr).encode(),
+                     str(CHAR_UUID_MODEL_NUMBER_STRING): self.model_nr.encode(),
+                     str(CHAR_UUID_DEVICE_NAME): self.device_name.encode(),
+                     str(CHAR_UUID_FIRMWARE_REV): b"G-BLE-1.5.3-master+0",
+                     str(CHAR_UUID_HARDWARE_REV): b"REV A"}
+        self.characteristics = [SimulatedCharacteristic(str(uuid), 13 + 3 * i, ["read", "write", "indicate"] if uuid == COMMAND_UUID else ["read"])
+                                for i, uuid in enumerate(sensor_uuids)]
+
+        self.temperature = rng.uniform(18, 24)
+        self.humidity = rng.uniform(30, 60)
+        self.pressure = rng.uniform(990, 1030)
+        self.co2 = rng.uniform(400, 1200)
+        self.voc = rng.uniform(50, 300)
+        self.radon_1day_avg = rng.uniform(10, 150)
+        self.radon_longterm_avg = self.radon_1day_avg
+        self.illuminance = rng.randint(0, 100)
+        self.battery = rng.uniform(2.6, 3.1)
+
+    def adapter_rssi(self, adapter):
+        # Each adapter hears the device with a different, but steady, signal strength.
+        if adapter is None:
+            return self.rssi
+        return self.rssi + zlib.crc32((self.mac + adapter).encode()) % 21 - 10
+
+    @property
+    def manufacturer_data(self):
+        # Airthings devices advertise their serial number, which starts with the model number.
+        return {820: struct.pack('<LH', self.serial_nr, 0)}
+
+    def _measure(self):
+        # Take a new measurement whenever a measurement period has passed.
+        counter = int((time.monotonic() + self._phase) // self.measurement_period)
+        if counter == self._counter:
+            return
+        self._counter = counter
+        rng = self._rng
+        self.temperature = min(30, max(15, self.temperature + rng.gauss(0, 0.1)))
+        self.humidity = min(90, max(20, self.humidity + rng.gauss(0, 0.5)))
+        self.pressure = min(1050, max(950, self.pressure + rng.gauss(0, 0.2)))
+        self.co2 = min(5000, max(400, self.co2 + rng.gauss(0, 20)))
+        self.voc = min(2000, max(0, self.voc + rng.gauss(0, 5)))
+        self.radon_1day_avg = min(500, max(0, self.radon_1day_avg + rng.gauss(0, 2)))
+        self.radon_longterm_avg += (self.radon_1day_avg - self.radon_longterm_avg) / 100.0
+        self.illuminance = rng.randint(0, 100)
+        self.battery = max(2.4, self.battery - 0.0001)
+
+    def read(self, uuid):
+        if uuid in self.info:
+            return self.info[uuid]
+        if uuid == str(CHAR_UUID_DATETIME):
+            return struct.pack('HBBBBB', *time.localtime()[:6])
+        self._measure()
+        if uuid == str(CHAR_UUID_WAVE_PLUS_DATA):
+            return struct.pack('BBBBHHHHHHHH', 1, round(self.humidity * 2), self.illuminance, 0, round(self.radon_1day_avg),
+                               round(self.radon_longterm_avg), round(self.temperature * 100), round(self.pressure * 50),
+                               round(self.co2), round(self.voc), 0, 0)
+        if uuid == str(CHAR_UUID_WAVE_2_DATA):
+            return struct.pack('<4B8H', 1, round(self.humidity * 2), 0, 0, round(self.radon_1day_avg), round(self.radon_longterm_avg),
+                               round(self.temperature * 100), 0, 0, 0, 0, 0)
+        if uuid == str(CHAR_UUID_WAVEMINI_DATA):
+            return struct.pack('<HHHHHHLL', 1, round((self.temperature + 273.15) * 100), 0, round(self.humidity * 100),
+                               round(self.voc), 0, 0, 0)
+        raise Exception("Characteristic {} can not be read".format(uuid))
+
+    def command(self, data):
+        # Answer the "Access Control Point" command with the battery, illuminance and the
+        # measurement counter.
+        if data != struct.pack('<B', 0x6d):
+            return None
+        self._measure()
+        values = [0] * 19
+        values[2] = self.illuminance
+        values[5] = self._counter % 256
+        values[17] = round(self.battery * 1000)
+        return data + b'\x00' + struct.pack('<L12B6H', *values)
+
+
+class SimulatedClient:
+    def __init__(self, transport, mac, disconnected_callback=None, adapter=None):
+        self.address = mac.upper()
+        self.adapter = adapter
+        self._transport = transport
+        self._device = transport.devices.get(mac.lower())
+        self._disconnected_callback = disconnected_callback
+        self._notify = {}
+        self.is_connected = False
+
+    def _uuid(self, char_specifier):
+        if isinstance(char_specifier, int):
+            for c in self._device.characteristics:
+                if c.handle == char_specifier:
+                    return c.uuid
+            raise Exception("Characteristic with handle {} was not found".format(char_specifier))
+        return str(getattr(char_specifier, "uuid", char_specifier))
+
+    async def _delay(self, latency):
+        await asyncio.sleep(latency * self._transport.rng.uniform(0.5, 1.5))
+
+    async def connect(self, **kwargs):
+        await self._delay(self._transport.connect_latency)
+        if self._device is None or self._transport.rng.random() < self._transport.connect_failure_rate:
+            raise Exception("Simulated connection failure for {}".format(self.address))
+        self.is_connected = True
+        return True
+
+    async def disconnect(self):
+        if self.is_connected:
+            self.is_connected = False
+            if self._disconnected_callback is not None:
+                self._disconnected_callback(self)
+        return True
+
+    async def get_services(self):
+        return [SimulatedService("b42e1c08-ade7-11e4-89d3-123b93f75cba", list(self._device.characteristics))]
+
+    @property
+    def services(self):
+        return [SimulatedService("b42e1c08-ade7-11e4-89d3-123b93f75cba", list(self._device.characteristics))]
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        if not self.is_connected:
+            raise Exception("Not connected")
+        await self._delay(self._transport.read_latency)
+        if self._transport.rng.random() < self._transport.read_failure_rate:
+            raise Exception("Simulated read failure for {}".format(self.address))
+        return bytearray(self._device.read(self._uuid(char_specifier)))
+
+    async def write_gatt_char(self, char_specifier, data, response=False):
+        if not self.is_connected:
+            raise Exception("Not connected")
+        await self._delay(self._transport.read_latency)
+        uuid = self._uuid(char_specifier)
+        reply = self._device.command(bytes(data)) if uuid == str(COMMAND_UUID) else None
+        if reply is not None and uuid in self._notify:
+            callback = self._notify[uuid]
+            asyncio.get_running_loop().call_later(self._transport.read_latency, callback, char_specifier, bytearray(reply))
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self._notify[self._uuid(char_specifier)] = callback
+
+    async def stop_notify(self, char_specifier):
+        self._notify.pop(self._uuid(char_specifier), None)
+
+
+class SimulatedScanner:
+    def __init__(self, transport, detection_callback=None, interval=1.0, adapter=None):
+        self._transport = transport
+        self._adapter = adapter
+        self._detection_callback = detection_callback
+        self._interval = interval
+        self._task = None
+
+    async def _advertise(self):
+        rng = self._transport.rng
+        while True:
+            for device in self._transport.devices.values():
+                rssi = device.adapter_rssi(self._adapter) + rng.randint(-5, 5)
+                self._detection_callback(SimulatedBLEDevice(device.mac.upper(), device.device_name, rssi, {}),
+                                         SimulatedAdvertisementData(device.manufacturer_data, rssi))
+            await asyncio.sleep(self._interval)
+
+    async def start(self):
+        self._task = asyncio.ensure_future(self._advertise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class SimulatedTransport:
+    """Simulates a fleet of Airthings Wave Plus, Wave (gen 2) and Wave Mini devices, returning
+    correctly packed sensor data, with configurable latency and failure rates."""
+
+    def __init__(self, wave_plus=0, wave2=0, wave_mini=0, connect_latency=0.5, read_latency=0.05,
+                 connect_failure_rate=0.0, read_failure_rate=0.0, measurement_period=300, seed=None):
+        self.connect_latency = connect_latency
+        self.read_latency = read_latency
+        self.connect_failure_rate = connect_failure_rate
+        self.read_failure_rate = read_failure_rate
+        self.rng = random.Random(seed)
+        self.devices = {}
+        for model, count in (("wave_plus", wave_plus), ("wave2", wave2), ("wave_mini", wave_mini)):
+            for _ in range(count):
+                n = len(self.devices) + 1
+                mac = "a4:da:22:{:02x}:{:02x}:{:02x}".format(n >> 16 & 0xff, n >> 8 & 0xff, n & 0xff)
+                serial_nr = int(MODELS[model][0]) * 1000000 + n
+                self.devices[mac] = SimulatedDevice(mac, model, serial_nr, self.rng, measurement_period)
+
+    def client(self, mac, disconnected_callback=None, adapter=None):
+        return SimulatedClient(self, mac, disconnected_callback, adapter)
+
+    def scanner(self, detection_callback=None, adapter=None):
+        return SimulatedScanner(self, detection_callback, adapter=adapter)
@@ -0,0 +1,133 @@
+# Copyright (c) 2022 Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import asyncio, math, os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from aggregates import Aggregates, RollingWindow, parse_stat, window_name
+from airthings import AirthingsWaveDetect, Reading
+from simulator import SimulatedTransport
+
+
+class RollingWindowTest(unittest.TestCase):
+
+    def test_eviction(self):
+        w = RollingWindow(10, counts=True)
+        for t, value in enumerate([5, 1, 9, 3, 7]):
+            w.add(t, value)
+        self.assertEqual((w.min(), w.max(), w.mean()), (1, 9, 5))
+        self.assertEqual([w.percentile(p) for p in (0, 50, 95, 100)], [1, 5, 9, 9])
+        # At 12 the values added at 0, 1 and 2 are older than the window.
+        w.expire(12)
+        self.assertEqual(len(w), 2)
+        self.assertEqual((w.min(), w.max(), w.mean()), (3, 7, 5))
+        self.assertEqual([w.percentile(p) for p in (0, 50, 100)], [3, 3, 7])
+        w.expire(100)
+        self.assertEqual((w.min(), w.max(), w.mean(), w.percentile(50)), (None, None, None, None))
+
+    def test_repeated_values(self):
+        w = RollingWindow(3, counts=True)
+        for t, value in enumerate([2, 2, 2, 4, 4]):
+            w.add(t, value)
+        self.assertEqual(w._counts, {2: 1, 4: 2})
+        self.assertEqual(w._keys, [2, 4])
+        self.assertEqual(w.percentile(30), 2)
+        self.assertEqual(w.percentile(40), 4)
+
+    def test_no_drift(self):
+        w = RollingWindow(100)
+        for t in range(100000):
+            w.add(t, 0.1 if t % 2 else 1e6)
+        self.assertEqual(w.mean(), math.fsum(0.1 if t % 2 else 1e6 for t in range(99900, 100000)) / 100)
+
+    def test_names(self):
+        self.assertEqual([window_name(s) for s in (86400, 900, 45)], ["24h", "15m", "45s"])
+        self.assertEqual((parse_stat("MEAN"), parse_stat("p95")), ("mean", 95.0))
+        self.assertRaises(ValueError, parse_stat, "p101")
+
+
+class AggregatesTest(unittest.TestCase):
+
+    def test_statistics(self):
+        aggregates = Aggregates([{"sensor": "co2", "window": 3600, "stats": ["mean", "max"]},
+                                 {"sensor": "voc", "window": 86400, "stats": ["P95"]}])
+        self.assertEqual(aggregates.sensors, {"co2_mean_1h": "co2", "co2_max_1h": "co2", "voc_p95_24h": "voc"})
+        aggregates.add("aa", 0, Reading(co2=400, voc=100, measurement_periods=1))
+        results = aggregates.add("aa", 1800, Reading(co2=600, voc=300, measurement_periods=2))
+        self.assertEqual(results, {"co2_mean_1h": 500, "co2_max_1h": 600, "voc_p95_24h": 300})
+        # The first reading leaves the hour window, but not the day window.
+        results = aggregates.add("aa", 3700, Reading(co2=500, measurement_periods=3))
+        self.assertEqual(results, {"co2_mean_1h": 550, "co2_max_1h": 600, "voc_p95_24h": 300})
+        # Devices are kept apart.
+        self.assertEqual(aggregates.add("bb", 3700, Reading(co2=800)), {"co2_mean_1h": 800, "co2_max_1h": 800})
+
+    def test_no_values(self):
+        aggregates = Aggregates([{"sensor": "co2", "window": 60}])
+        self.assertEqual(aggregates.add("aa", 0, Reading(voc=100)), {})
+        self.assertFalse(Aggregates([]))
+
+
+class NewMeasurementTest(unittest.TestCase):
+    """Each measurement is added to the windows once, however often it is read."""
+
+    def setUp(self):
+        self.aggregates = Aggregates([{"sensor": "co2", "window": 3600, "stats": ["mean"]}])
+
+    def _count(self, mac):
+        return len(self.aggregates._devices[mac][("co2", 3600)])
+
+    def test_counter(self):
+        self.aggregates.add("aa", 0, Reading(co2=400, measurement_periods=1))
+        self.aggregates.add("aa", 10, Reading(co2=400, measurement_periods=1))
+        self.aggregates.add("aa", 300, Reading(co2=410, measurement_periods=2))
+        self.assertEqual(self._count("aa"), 2)
+
+    def test_stale_counter(self):
+        # The counter was only read with the first reading, so the values are compared.
+        data = Reading(co2=400, measurement_periods=1)
+        self.aggregates.add("aa", 0, data)
+        for t, co2 in ((300, 410), (310, 410), (600, 420)):
+            fresh = Reading(co2=co2)
+            data.update(fresh)
+            self.aggregates.add("aa", t, data, fresh)
+        self.assertEqual(self._count("aa"), 3)
+
+    def test_read_every(self):
+        # The counter comes with the battery, which is only read every 5th reading here.
+        period = 0.05
+        transport = SimulatedTransport(wave_plus=1, connect_latency=0, read_latency=0, measurement_period=period, seed=1)
+        detect = AirthingsWaveDetect(0, transport=transport, read_every={"battery": 5})
+        detect.airthing_devices = list(transport.devices)
+        detect.on_reading = lambda mac, data, fresh: self.aggregates.add(mac, data.timestamp, data, fresh)
+
+        async def run():
+            await detect.onboard()
+            for _ in range(10):
+                await asyncio.sleep(period * 1.5)
+                await detect.get_sensor_data()
+            await detect.close()
+        asyncio.run(run())
+        self.assertEqual(self._count(detect.airthing_devices[0]), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
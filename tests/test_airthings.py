@@ -0,0 +1,193 @@
+# Copyright (c) 2022 Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import asyncio, os, struct, sys, time, unittest
+from collections import namedtuple
+from datetime import datetime
+from uuid import UUID
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from airthings import (CHAR_UUID_DATETIME, CHAR_UUID_WAVE_PLUS_DATA, CHAR_UUID_WAVEMINI_DATA, COMMAND_UUID,
+                       AirthingsWaveDetect, DecoderRegistry, MeasurementSchedule, PollingRules, Reading, command_decoders,
+                       sensor_decoders)
+from simulator import SimulatedTransport
+
+Characteristic = namedtuple("Characteristic", ["uuid", "handle"])
+
+# humidity 45%, radon 120 and 80 Bq/m3, 21.5 C, 1000.5 hPa, 850 ppm CO2 and 150 ppb VOC.
+PLUS_FRAME = struct.pack('BBBBHHHHHHHH', 1, 90, 0, 0, 120, 80, 2150, 50025, 850, 150, 0, 0)
+COMMAND_FRAME = struct.pack('<B', 0x6d) + b'\x00' + struct.pack('<L12B6H', 0, 0, 42, 0, 0, 7, *[0] * 11, 2950, 0)
+
+
+class DecoderRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoders = DecoderRegistry(sensor_decoders, command_decoders)
+
+    def test_lookup(self):
+        decoder = self.decoders.get(str(CHAR_UUID_WAVE_PLUS_DATA))
+        self.assertIsNotNone(decoder)
+        self.assertIs(self.decoders.get(CHAR_UUID_WAVE_PLUS_DATA), decoder)
+        self.assertIs(self.decoders.get(Characteristic(str(CHAR_UUID_WAVE_PLUS_DATA), 13)), decoder)
+        self.assertIsNone(self.decoders.get(UUID(int=0)))
+        self.assertTrue(self.decoders.is_command(self.decoders.get(COMMAND_UUID)))
+        self.assertFalse(self.decoders.is_command(decoder))
+
+    def test_decode(self):
+        reading = self.decoders.decode(CHAR_UUID_WAVE_PLUS_DATA, PLUS_FRAME, timestamp=1000.0)
+        self.assertEqual(dict(reading.items()), {"humidity": 45.0, "radon_1day_avg": 120, "radon_longterm_avg": 80, "temperature": 21.5,
+                                                 "rel_atm_pressure": 1000.5, "co2": 850.0, "voc": 150.0})
+        self.assertEqual(reading.timestamp, 1000.0)
+        self.assertRaises(KeyError, self.decoders.decode, UUID(int=0), PLUS_FRAME)
+
+    def test_decode_batch_by_handle(self):
+        characteristics = [Characteristic(str(CHAR_UUID_WAVE_PLUS_DATA), 13), Characteristic(str(CHAR_UUID_DATETIME), 16),
+                           Characteristic(str(COMMAND_UUID), 19), Characteristic("b42e0000-ade7-11e4-89d3-123b93f75cba", 22)]
+        handles = self.decoders.bind("aa", characteristics)
+        self.assertEqual(sorted(handles), [13, 16, 19])
+        clock = struct.pack('HBBBBB', 2022, 8, 5, 12, 30, 0)
+        reading = self.decoders.decode_batch([(13, memoryview(PLUS_FRAME)), (16, clock)], "aa")
+        self.decoders.for_handle("aa", 19).decode_into(reading, COMMAND_FRAME)
+        self.assertEqual((reading.co2, reading.illuminance, reading.measurement_periods, reading.battery), (850.0, 42, 7, 2.95))
+        self.assertEqual(reading.device_time, datetime(2022, 8, 5, 12, 30).timestamp())
+        self.assertRaises(KeyError, self.decoders.decode_batch, [(22, b"")], "aa")
+
+    def test_command_reply(self):
+        decoder = self.decoders.get(COMMAND_UUID)
+        self.assertEqual(decoder.decode_data(COMMAND_FRAME).battery, 2.95)
+        # A reply to another command, or of the wrong length, is ignored.
+        self.assertFalse(decoder.decode_data(b'\x01' + COMMAND_FRAME[1:]))
+        self.assertFalse(decoder.decode_data(COMMAND_FRAME[:-1]))
+        self.assertFalse(decoder.decode_data(None))
+
+    def test_decode_recorded(self):
+        frames = [struct.pack('<HHHHHHLL', 1, 29465 + i, 0, 5000, 100 + i, 0, 0, 0) for i in range(3)]
+        readings = list(self.decoders.decode_recorded(CHAR_UUID_WAVEMINI_DATA, b"".join(frames) + b"\x00", timestamp=5.0))
+        self.assertEqual([(r.temperature, r.voc) for r in readings], [(21.5, 100.0), (21.51, 101.0), (21.52, 102.0)])
+        self.assertRaises(KeyError, list, self.decoders.decode_recorded(COMMAND_UUID, b""))
+        self.assertRaises(KeyError, list, self.decoders.decode_recorded(UUID(int=0), b""))
+
+
+class MeasurementScheduleTest(unittest.TestCase):
+    """A device that measures every period seconds, starting at phase."""
+
+    def _run(self, period, phase, polls=60, fallback=150, until=None):
+        schedule = MeasurementSchedule(margin=10)
+        now, times = 0.0, []
+        while len(times) < polls:
+            counter = int((min(now, until or now) - phase) // period)
+            schedule.update(now, counter % 256)
+            times.append(now)
+            now = schedule.next_poll(now, fallback)
+        return schedule, times
+
+    def test_convergence(self):
+        for period, phase in ((300, 17), (300, 299), (290, 150), (310, 0.5)):
+            schedule, times = self._run(period, phase)
+            self.assertAlmostEqual(schedule.period, period, delta=1)
+            # Each reading comes soon after a measurement, and there is one per measurement.
+            late = [(t - phase) % period for t in times[-10:]]
+            self.assertTrue(all(0 < s <= 2 * schedule.margin for s in late), late)
+            self.assertEqual(len(set(int((t - phase) // period) for t in times[-10:])), 10)
+
+    def test_learning(self):
+        schedule = MeasurementSchedule()
+        schedule.update(0, 5)
+        self.assertEqual(schedule.next_poll(0, 150), 75)
+        self.assertEqual(schedule.next_poll(0, 60), 60)
+        # Without a new measurement the checks get further apart.
+        schedule.update(75, 5)
+        schedule.update(150, 5)
+        self.assertEqual(schedule.next_poll(150, 1000), 300)
+
+    def test_late_measurement(self):
+        # The device stops measuring, so it is read again soon and then less and less often.
+        schedule, times = self._run(300, 17, polls=40, until=5000)
+        gaps = [b - a for a, b in zip(times, times[1:]) if a > 5000]
+        self.assertEqual(gaps[:4], [15, 30, 60, 120])
+        self.assertTrue(all(gap == 150 for gap in gaps[4:]))
+
+
+class PollingRulesTest(unittest.TestCase):
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, PollingRules, [{"sensor": "co2"}])
+        self.assertRaises(ValueError, PollingRules, [{"sensor": "co2", "above": 1000, "below": 400}])
+        self.assertRaises(ValueError, PollingRules, [{"above": 1000}])
+
+    def test_threshold(self):
+        rules = PollingRules([{"sensor": "co2", "above": 1000}, {"sensor": "temperature", "below": 15}])
+        self.assertFalse(rules.update("aa", Reading(monotonic=0, co2=1000, temperature=20)))
+        self.assertTrue(rules.update("aa", Reading(monotonic=60, co2=1001, temperature=20)))
+        self.assertEqual(rules.fast, {"aa"})
+        # The device stays fast while any rule matches, and only goes back once none do.
+        self.assertTrue(rules.update("aa", Reading(monotonic=120, co2=900, temperature=14)))
+        self.assertTrue(rules.update("aa", Reading(monotonic=180, co2=900, temperature=14.9)))
+        self.assertFalse(rules.update("aa", Reading(monotonic=240, co2=900, temperature=15)))
+        self.assertEqual(rules.fast, set())
+        # Values that were not read do not match.
+        self.assertFalse(rules.update("bb", Reading(monotonic=0, voc=100)))
+
+    def test_slope(self):
+        rules = PollingRules([{"sensor": "co2", "rising": 200}, {"sensor": "radon_1day_avg", "falling": 10}], slope_window=900)
+        # Not known until a quarter of the window has passed.
+        self.assertFalse(rules.update("aa", Reading(monotonic=0, co2=400)))
+        self.assertFalse(rules.update("aa", Reading(monotonic=200, co2=500)))
+        # 500 ppm in 300 seconds is 6000 ppm an hour.
+        self.assertTrue(rules.update("aa", Reading(monotonic=300, co2=900)))
+        # Worked out over the last 900 seconds (or the oldest reading kept), so the early
+        # rise is soon forgotten.
+        self.assertFalse(rules.update("aa", Reading(monotonic=2100, co2=1000)))
+        self.assertFalse(rules.update("aa", Reading(monotonic=3000, co2=1040)))
+        self.assertTrue(rules.update("aa", Reading(monotonic=3300, co2=1100)))
+        self.assertFalse(rules.update("bb", Reading(monotonic=0, radon_1day_avg=100)))
+        self.assertTrue(rules.update("bb", Reading(monotonic=1800, radon_1day_avg=80)))
+        self.assertEqual(rules.fast, {"aa", "bb"})
+
+
+class CycleTimeoutTest(unittest.TestCase):
+
+    def test_deadline(self):
+        transport = SimulatedTransport(wave_plus=6, connect_latency=0.1, read_latency=0, seed=1)
+        detect = AirthingsWaveDetect(0, transport=transport, cycle_timeout=0.25)
+        detect.airthing_devices = list(transport.devices)
+
+        async def run():
+            await detect.onboard()
+            start = time.monotonic()
+            await detect.get_sensor_data()
+            await detect.close()
+            return start
+        start = asyncio.run(run())
+        # The devices read in time are kept, those not started are reported and stay due,
+        # and the one cut off counts as a failure.
+        self.assertTrue(detect.updated)
+        self.assertTrue(detect.missed)
+        self.assertFalse(detect.updated & detect.missed)
+        self.assertTrue(all(detect.next_poll[mac] <= start for mac in detect.missed))
+        failed = [mac for mac, health in detect.health.items() if health.failures > 0]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(len(detect.updated) + len(detect.missed) + len(failed), 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# Copyright (c) 2022 Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from buffer import ReadingBuffer
+
+
+class TornLineTest(unittest.TestCase):
+    """A power loss while appending can leave part of a line at the end of a segment."""
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _tear(self):
+        # Write two readings, then part of a third as if the power went out.
+        buffer = ReadingBuffer(self.path)
+        buffer.append(1000.0, "aa", {"co2": 400})
+        buffer.append(1001.0, "aa", {"co2": 410})
+        with open(os.path.join(self.path, "{:010d}.jsonl".format(1)), "ab") as f:
+            f.write(b'{"t":1002.0,"mac":"aa","v":{"co2"')
+        return buffer
+
+    def _drain(self, buffer):
+        readings = []
+        for _ in range(10):
+            if not buffer:
+                break
+            batch, position = buffer.read_batch()
+            buffer.commit(position)
+            readings.extend(batch)
+        self.assertFalse(buffer, "buffer never emptied")
+        return readings
+
+    def test_torn_line_after_restart(self):
+        self._tear()
+        buffer = ReadingBuffer(self.path)
+        buffer.append(1003.0, "aa", {"co2": 430})
+        self.assertEqual([r["t"] for r in self._drain(buffer)], [1000.0, 1001.0, 1003.0])
+
+    def test_torn_line_while_running(self):
+        buffer = self._tear()
+        buffer._sizes[1] = os.path.getsize(os.path.join(self.path, "{:010d}.jsonl".format(1)))
+        self.assertEqual([r["t"] for r in self._drain(buffer)], [1000.0, 1001.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
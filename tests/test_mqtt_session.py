@@ -0,0 +1,128 @@
+# Copyright (c) 2022 Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import asyncio, os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import paho.mqtt.client as mqtt
+
+from mqtt_session import MQTTSession, PublishFilter
+
+
+class SilentBroker:
+    """Takes the place of the paho client, only acknowledging messages when told to."""
+
+    def __init__(self):
+        self.on_connect = self.on_disconnect = self.on_publish = self.on_message = None
+        self.mid = 0
+
+    def max_inflight_messages_set(self, inflight): pass
+    def max_queued_messages_set(self, queue_size): pass
+    def reconnect_delay_set(self, min_delay=1, max_delay=120): pass
+    def is_connected(self): return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.mid += 1
+        info = mqtt.MQTTMessageInfo(self.mid)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        return info
+
+
+class MQTTSessionTest(unittest.TestCase):
+
+    def test_late_acknowledgement(self):
+        broker = SilentBroker()
+        session = MQTTSession("localhost", client=broker)
+
+        async def run():
+            session._loop = asyncio.get_running_loop()
+            self.assertFalse(await session.publish_multiple([{"topic": "a", "payload": 1}], timeout=0.01))
+            # The broker answers late, then paho wraps around to the same mid.
+            broker.on_publish(broker, None, 1)
+            broker.mid = 0
+            future = session.publish("b", 2)
+            await asyncio.sleep(0.01)
+            self.assertFalse(future.done())
+            broker.on_publish(broker, None, 1)
+            await asyncio.sleep(0.01)
+            self.assertTrue(future.done())
+        asyncio.run(run())
+        self.assertEqual((session._pending, session._completed, session._timed_out), ({}, {}, {}))
+
+
+class PublishFilterTest(unittest.TestCase):
+
+    def test_unchanged(self):
+        f = PublishFilter()
+        self.assertTrue(f.changed("airthings/aa/co2", "co2", 400, now=0))
+        self.assertFalse(f.changed("airthings/aa/co2", "co2", 400, now=1))
+        self.assertTrue(f.changed("airthings/aa/co2", "co2", 401, now=2))
+        self.assertTrue(f.changed("airthings/aa/co2", "co2", 400, now=3))
+
+    def test_deadband(self):
+        f = PublishFilter({"co2": 10})
+        f.changed("airthings/aa/co2", "co2", 400, now=0)
+        self.assertFalse(f.changed("airthings/aa/co2", "co2", 409, now=1))
+        self.assertFalse(f.changed("airthings/aa/co2", "co2", 391, now=2))
+        # Moves are measured from the last value sent, so slow drift is still sent.
+        self.assertTrue(f.changed("airthings/aa/co2", "co2", 410, now=3))
+        self.assertFalse(f.changed("airthings/aa/co2", "co2", 401, now=4))
+        # Other sensors have no deadband.
+        f.changed("airthings/aa/voc", "voc", 100, now=0)
+        self.assertTrue(f.changed("airthings/aa/voc", "voc", 101, now=1))
+
+    def test_text(self):
+        f = PublishFilter({"co2": 10})
+        f.changed("airthings/aa/co2", "co2", "n/a", now=0)
+        self.assertFalse(f.changed("airthings/aa/co2", "co2", "n/a", now=1))
+        self.assertTrue(f.changed("airthings/aa/co2", "co2", 400, now=2))
+
+    def test_heartbeat(self):
+        f = PublishFilter(heartbeat=3600)
+        f.changed("airthings/aa/co2", "co2", 400, now=0)
+        f.changed("airthings/aa/voc", "voc", 100, now=1800)
+        self.assertFalse(f.changed("airthings/aa/co2", "co2", 400, now=3599))
+        self.assertTrue(f.changed("airthings/aa/co2", "co2", 400, now=3600))
+        # Each topic keeps its own time.
+        self.assertFalse(f.changed("airthings/aa/voc", "voc", 100, now=3600))
+        self.assertTrue(f.changed("airthings/aa/voc", "voc", 100, now=5400))
+        self.assertFalse(f.changed("airthings/aa/co2", "co2", 400, now=5400))
+
+    def test_no_heartbeat(self):
+        f = PublishFilter(heartbeat=0)
+        f.changed("airthings/aa/co2", "co2", 400, now=0)
+        self.assertFalse(f.changed("airthings/aa/co2", "co2", 400, now=10 ** 9))
+
+    def test_reset_one_device(self):
+        f = PublishFilter()
+        for topic in ("airthings/aa/co2", "airthings/aa/voc", "airthings/bb/co2"):
+            f.changed(topic, topic.rsplit("/", 1)[1], 400, now=0)
+        f.reset("airthings/aa/")
+        self.assertTrue(f.changed("airthings/aa/co2", "co2", 400, now=1))
+        self.assertTrue(f.changed("airthings/aa/voc", "voc", 400, now=1))
+        self.assertFalse(f.changed("airthings/bb/co2", "co2", 400, now=1))
+        f.reset()
+        self.assertTrue(f.changed("airthings/bb/co2", "co2", 400, now=2))
+
+
+if __name__ == "__main__":
+    unittest.main()